@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from graph_nodes import prefetch_retrieval
+from graph_workflow import agent, workflow
+from llm_chain_components import RAG_GENERATION_TAG
+from qdrant_manager import QdrantManager
+from semantic_cache import answer_cache
+from tracing import RequestTrace, trace_config
+
+# latency budget (seconds) of a question, the graph stops query corrections when it's running out
+REQUEST_DEADLINE = float(os.getenv("REQUEST_DEADLINE", 20))
+# batch answering: questions per request & questions of a batch answered by the graph at the same time
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", 10000))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", 8))
+# questions embedded & retrieved at a time, as a multiple of the batch concurrency
+BATCH_PREFETCH_WINDOW = int(os.getenv("BATCH_PREFETCH_WINDOW", 4))
+
+
+class LoopStats:
+    """Query correction loops & web search fallbacks of questions answered by the graph (cache hits excluded)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.questions = 0
+        self.query_corrections = Counter()
+        self.web_searches = 0
+
+    def record(self, results: dict):
+        with self._lock:
+            self.questions += 1
+            self.query_corrections[results.get("query_correction_count", 0)] += 1
+            self.web_searches += 1 if results.get("web_search_docs") is not None else 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            corrections = sum(count * questions for count, questions in self.query_corrections.items())
+            return {
+                "questions": self.questions,
+                "avg_query_corrections": corrections / self.questions if self.questions else 0.0,
+                "query_corrections": {str(count): questions for count, questions in sorted(self.query_corrections.items())},
+                "web_search_rate": self.web_searches / self.questions if self.questions else 0.0,
+            }
+
+
+loop_stats = LoopStats()
+
+
+def build_inputs(question: str, collection_name: str, retrieved_points: list = None,
+                 hybrid_search: bool = None) -> dict:
+    inputs = {
+        "question": question,
+        "collection_name": collection_name,
+        "query_correction_count": 0,
+        "last_iteration_state": {},
+        "deadline": time.time() + REQUEST_DEADLINE
+    }
+    if retrieved_points is not None:
+        inputs["retrieved_points"] = retrieved_points
+    if hybrid_search is not None:
+        inputs["hybrid_search"] = hybrid_search
+    return inputs
+
+
+def get_answer(question: str, collection_name: str) -> dict:
+    query_vector = QdrantManager(collection_name).embed_query(question)
+    cached_answer = answer_cache.lookup(collection_name, query_vector)
+    if cached_answer is not None:
+        return cached_answer
+    return run_agent(question, collection_name, query_vector)
+
+
+def run_agent(question: str, collection_name: str, query_vector, retrieved_points: list = None) -> dict:
+    trace = RequestTrace(question, collection_name)
+    results = agent.invoke(build_inputs(question, collection_name, retrieved_points), config=trace_config(trace))
+    trace.finish()
+    loop_stats.record(results)
+    answer = {
+        "generation": results["generation"],
+        "documents": results["documents"]
+    }
+    answer_cache.store(collection_name, query_vector, answer)
+    return answer
+
+
+async def aget_answer(question: str, collection_name: str) -> dict:
+    query_vector = await asyncio.to_thread(QdrantManager(collection_name).embed_query, question)
+    cached_answer = answer_cache.lookup(collection_name, query_vector)
+    if cached_answer is not None:
+        return cached_answer
+    return await arun_agent(question, collection_name, query_vector)
+
+
+async def arun_agent(question: str, collection_name: str, query_vector, retrieved_points: list = None) -> dict:
+    trace = RequestTrace(question, collection_name)
+    results = await agent.ainvoke(build_inputs(question, collection_name, retrieved_points),
+                                  config=trace_config(trace))
+    trace.finish()
+    loop_stats.record(results)
+    answer = {
+        "generation": results["generation"],
+        "documents": results["documents"]
+    }
+    answer_cache.store(collection_name, query_vector, answer)
+    return answer
+
+
+async def astream_answer(question: str, collection_name: str):
+    """
+    Streams the agent's work on a question.
+
+    Yields (event, data) pairs: 'progress' after every finished graph node, 'token' for every generated
+    answer chunk and 'sources' with the final documents at the end.
+    """
+    query_vector = await asyncio.to_thread(QdrantManager(collection_name).embed_query, question)
+    cached_answer = answer_cache.lookup(collection_name, query_vector)
+    if cached_answer is not None:
+        yield "progress", {"node": "cache"}
+        yield "token", {"content": cached_answer["generation"]}
+        yield "sources", {"documents": cached_answer["documents"]}
+        return
+
+    state = {}
+    trace = RequestTrace(question, collection_name)
+    async for event in agent.astream_events(build_inputs(question, collection_name), config=trace_config(trace),
+                                            version="v2"):
+        if event["event"] == "on_chain_end" and event["name"] in workflow.nodes:
+            output = event["data"].get("output")
+            if isinstance(output, dict):
+                state.update(output)
+            yield "progress", {"node": event["name"]}
+        elif event["event"] == "on_chat_model_stream" and RAG_GENERATION_TAG in event.get("tags", []):
+            content = event["data"]["chunk"].content
+            if content:
+                yield "token", {"content": content}
+
+    trace.finish()
+    loop_stats.record(state)
+    answer = {
+        "generation": state.get("generation"),
+        "documents": state.get("documents")
+    }
+    answer_cache.store(collection_name, query_vector, answer)
+    yield "sources", {"documents": answer["documents"]}
+
+
+def stream_answer(question: str, collection_name: str):
+    """Sync version of astream_answer for WSGI servers, runs the stream on its own event loop."""
+    loop = asyncio.new_event_loop()
+    events = astream_answer(question, collection_name)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(events.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(events.aclose())
+        loop.close()
+
+
+def validate_batch(questions, collection_name) -> str:
+    """Returns the error message of an invalid batch of questions or collection, None for a valid one."""
+    if not isinstance(collection_name, str) or not collection_name.strip():
+        return "'collection_name' (or the Collection-Name header) is required"
+    if not isinstance(questions, list) or not questions:
+        return "'questions' must be a non-empty list"
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        return f"At most {BATCH_MAX_QUESTIONS} questions per batch"
+    if not all(isinstance(question, str) and question.strip() for question in questions):
+        return "Every question must be a non-empty string"
+    return None
+
+
+def prepare_batch(questions: list[str], collection_name: str, start: int, stop: int) -> tuple[list, list]:
+    """
+    Embeds the questions[start:stop] window with a single model call & retrieves documents of the not cached ones
+    with one batch search.
+
+    Returns:
+        tuple: (index, cached answer) pairs & (index, query vector, retrieved points) of questions for the graph
+    """
+    query_vectors = QdrantManager(collection_name).embed_queries(questions[start:stop])
+    cached, pending = [], []
+    for index, query_vector in enumerate(query_vectors, start):
+        cached_answer = answer_cache.lookup(collection_name, query_vector)
+        if cached_answer is not None:
+            cached.append((index, cached_answer))
+        else:
+            pending.append((index, query_vector))
+    retrieved = prefetch_retrieval(collection_name, [questions[index] for index, _ in pending],
+                                   [query_vector for _, query_vector in pending]) if pending else []
+    return cached, [(index, query_vector, points) for (index, query_vector), points in zip(pending, retrieved)]
+
+
+def batch_windows(questions: list[str], max_concurrency: int) -> list[tuple[int, int]]:
+    window = max(1, max_concurrency * BATCH_PREFETCH_WINDOW)
+    return [(start, min(start + window, len(questions))) for start in range(0, len(questions), window)]
+
+
+def batch_result(index: int, question: str, answer: dict = None, error: Exception = None) -> dict:
+    if error is not None:
+        logging.error(f"Batch question {index} '{question}' failed: {error}")
+        return {"index": index, "question": question, "error": str(error)}
+    return {"index": index, "question": question, **answer}
+
+
+def answer_batch(questions: list[str], collection_name: str, max_concurrency: int = BATCH_MAX_CONCURRENCY):
+    """
+    Answers many questions, yielding the results in the order they're finished (cached answers first).
+
+    Questions are embedded & retrieved in windows of max_concurrency * BATCH_PREFETCH_WINDOW, the next window is
+    prefetched while the graph runs of the current one finish, so only about two windows of retrieved points are
+    held at a time. The graph runs for at most max_concurrency questions at a time, a failed question yields its
+    error instead of stopping the batch, a window failing to embed or retrieve yields the error for each of its
+    questions.
+    """
+    windows = batch_windows(questions, max_concurrency)
+    prefetcher = ThreadPoolExecutor(max_workers=1)
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    futures = {}
+
+    def finished(keep: int):
+        while len(futures) > keep:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                index = futures.pop(future)
+                error = future.exception()
+                yield batch_result(index, questions[index], None if error else future.result(), error)
+
+    try:
+        prefetch = prefetcher.submit(prepare_batch, questions, collection_name, *windows[0]) if windows else None
+        for window_i, (start, stop) in enumerate(windows):
+            try:
+                cached, pending = prefetch.result()
+                window_error = None
+            except Exception as e:
+                cached, pending = [], []
+                window_error = e
+            if window_i + 1 < len(windows):
+                prefetch = prefetcher.submit(prepare_batch, questions, collection_name, *windows[window_i + 1])
+            if window_error:
+                for index in range(start, stop):
+                    yield batch_result(index, questions[index], error=window_error)
+            for index, answer in cached:
+                yield batch_result(index, questions[index], answer)
+            for index, query_vector, points in pending:
+                futures[executor.submit(run_agent, questions[index], collection_name, query_vector, points)] = index
+            del pending
+            # the next window is taken once the running questions no longer fill the workers
+            yield from finished(keep=max_concurrency if window_i + 1 < len(windows) else 0)
+    finally:
+        # questions not started yet are dropped when the client goes away
+        executor.shutdown(wait=False, cancel_futures=True)
+        prefetcher.shutdown(wait=False, cancel_futures=True)
+
+
+async def aanswer_batch(questions: list[str], collection_name: str, max_concurrency: int = BATCH_MAX_CONCURRENCY):
+    """Async version of answer_batch."""
+    windows = batch_windows(questions, max_concurrency)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    tasks = set()
+
+    async def answer_question(index: int, query_vector, points: list):
+        async with semaphore:
+            try:
+                return batch_result(index, questions[index],
+                                    await arun_agent(questions[index], collection_name, query_vector, points))
+            except Exception as e:
+                return batch_result(index, questions[index], error=e)
+
+    prefetch = asyncio.create_task(asyncio.to_thread(prepare_batch, questions, collection_name, *windows[0])) \
+        if windows else None
+    try:
+        for window_i, (start, stop) in enumerate(windows):
+            try:
+                cached, pending = await prefetch
+                window_error = None
+            except Exception as e:
+                cached, pending = [], []
+                window_error = e
+            prefetch = asyncio.create_task(
+                asyncio.to_thread(prepare_batch, questions, collection_name, *windows[window_i + 1])
+            ) if window_i + 1 < len(windows) else None
+            if window_error:
+                for index in range(start, stop):
+                    yield batch_result(index, questions[index], error=window_error)
+            for index, answer in cached:
+                yield batch_result(index, questions[index], answer)
+            tasks.update(asyncio.create_task(answer_question(*question)) for question in pending)
+            del pending
+            keep = max_concurrency if window_i + 1 < len(windows) else 0
+            while len(tasks) > keep:
+                done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if prefetch is not None:
+            prefetch.cancel()
+
+
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def format_ndjson(data: dict) -> str:
+    return json.dumps(data) + "\n"
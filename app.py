@@ -1,7 +1,14 @@
 import json
-from flask import Flask, Response, request
+import atexit
+from flask import Flask, Response, request, stream_with_context
 from flask_cors import CORS
-from graph_workflow import workflow
+from agent_service import get_answer as answer_question, stream_answer as stream_answer_events, format_sse, loop_stats, \
+    answer_batch, validate_batch, format_ndjson
+from resource_pool import resource_pool, warm_up_collections
+from semantic_cache import answer_cache
+from embedding_cache import embedding_cache, sentence_cache
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from tracing import trace_log
 
 
 app = Flask(__name__)
@@ -11,6 +18,10 @@ cors = CORS(
     allow_headers="*",
 )
 
+resource_pool.warm_up(warm_up_collections())
+atexit.register(resource_pool.shutdown)
+atexit.register(embedding_cache.close)
+
 
 @app.route("/is_running", methods=['GET'])
 def is_running():
@@ -20,16 +31,59 @@ def is_running():
 @app.route("/get_answer/<query>", methods=['GET'])
 def get_answer(query: str):
     collection_name = request.headers.get("Collection-Name")
-    inputs = {
-        "question": query,
-        "collection_name": collection_name,
-        "query_correction_count": 0,
-        "last_iteration_state": {}
-    }
-    agent = workflow.compile()
-    results = agent.invoke(inputs)
-
-    return Response(json.dumps({
-        "generation": results["generation"],
-        "documents": results["documents"]
-    }), 200)
+    results = answer_question(query, collection_name)
+
+    return Response(json.dumps(results), 200)
+
+
+@app.route("/stream_answer/<query>", methods=['GET'])
+def stream_answer(query: str):
+    collection_name = request.headers.get("Collection-Name")
+    events = (format_sse(event, data) for event, data in stream_answer_events(query, collection_name))
+
+    return Response(stream_with_context(events), 200, mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.route("/get_answers", methods=['POST'])
+def get_answers():
+    body = request.get_json(silent=True)
+    body = body if isinstance(body, dict) else {}
+    questions = body.get("questions")
+    collection_name = body.get("collection_name") or request.headers.get("Collection-Name")
+    error = validate_batch(questions, collection_name)
+    if error:
+        return Response(error, 400)
+    lines = (format_ndjson(result) for result in answer_batch(questions, collection_name))
+
+    return Response(stream_with_context(lines), 200, mimetype="application/x-ndjson")
+
+
+@app.route("/cache_stats", methods=['GET'])
+def cache_stats():
+    return Response(json.dumps({"answers": answer_cache.stats(), "embeddings": embedding_cache.stats(),
+                                "sentences": sentence_cache.stats()}), 200)
+
+
+@app.route("/loop_stats", methods=['GET'])
+def get_loop_stats():
+    return Response(json.dumps(loop_stats.stats()), 200)
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    return Response(generate_latest(), 200, mimetype=CONTENT_TYPE_LATEST)
+
+
+@app.route("/traces", methods=['GET'])
+def get_traces():
+    limit = request.args.get("limit", type=int)
+    return Response(json.dumps(trace_log.recent(limit)), 200)
+
+
+@app.route("/traces/<trace_id>", methods=['GET'])
+def get_trace(trace_id: str):
+    trace = trace_log.get(trace_id)
+    if trace is None:
+        return Response("Trace not found", 404)
+    return Response(json.dumps(trace), 200)
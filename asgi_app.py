@@ -0,0 +1,118 @@
+import os
+import asyncio
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from agent_service import aget_answer, astream_answer, format_sse, loop_stats, aanswer_batch, validate_batch, \
+    format_ndjson
+from resource_pool import resource_pool, warm_up_collections
+from semantic_cache import answer_cache
+from embedding_cache import embedding_cache, sentence_cache
+from prometheus_client import generate_latest, CONTENT_TYPE_LATEST
+from tracing import trace_log
+
+
+@asynccontextmanager
+async def lifespan(_app: Starlette):
+    # sync graph nodes run in the loop's default executor, so it's sized for many in-flight questions waiting on I/O
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=int(os.getenv("ASGI_MAX_WORKERS", 64))))
+    await run_in_threadpool(resource_pool.warm_up, warm_up_collections())
+    yield
+    await run_in_threadpool(resource_pool.shutdown)
+    embedding_cache.close()
+
+
+async def is_running(_request: Request):
+    return PlainTextResponse("Running!", 200)
+
+
+async def get_answer(request: Request):
+    query = request.path_params["query"]
+    collection_name = request.headers.get("Collection-Name")
+    results = await aget_answer(query, collection_name)
+
+    return JSONResponse(results, 200)
+
+
+async def stream_answer(request: Request):
+    query = request.path_params["query"]
+    collection_name = request.headers.get("Collection-Name")
+
+    async def events():
+        async for event, data in astream_answer(query, collection_name):
+            yield format_sse(event, data)
+
+    return StreamingResponse(events(), 200, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+async def get_answers(request: Request):
+    try:
+        body = await request.json()
+    except ValueError:
+        body = None
+    body = body if isinstance(body, dict) else {}
+    questions = body.get("questions")
+    collection_name = body.get("collection_name") or request.headers.get("Collection-Name")
+    error = validate_batch(questions, collection_name)
+    if error:
+        return PlainTextResponse(error, 400)
+
+    async def lines():
+        async for result in aanswer_batch(questions, collection_name):
+            yield format_ndjson(result)
+
+    return StreamingResponse(lines(), 200, media_type="application/x-ndjson")
+
+
+async def cache_stats(_request: Request):
+    return JSONResponse({"answers": answer_cache.stats(), "embeddings": embedding_cache.stats(),
+                         "sentences": sentence_cache.stats()}, 200)
+
+
+async def get_loop_stats(_request: Request):
+    return JSONResponse(loop_stats.stats(), 200)
+
+
+async def metrics(_request: Request):
+    return Response(generate_latest(), 200, media_type=CONTENT_TYPE_LATEST)
+
+
+async def get_traces(request: Request):
+    limit = request.query_params.get("limit")
+    return JSONResponse(trace_log.recent(int(limit) if limit else None), 200)
+
+
+async def get_trace(request: Request):
+    trace = trace_log.get(request.path_params["trace_id"])
+    if trace is None:
+        return PlainTextResponse("Trace not found", 404)
+    return JSONResponse(trace, 200)
+
+
+app = Starlette(
+    routes=[
+        Route("/is_running", is_running, methods=["GET"]),
+        Route("/get_answer/{query}", get_answer, methods=["GET"]),
+        Route("/stream_answer/{query}", stream_answer, methods=["GET"]),
+        Route("/get_answers", get_answers, methods=["POST"]),
+        Route("/cache_stats", cache_stats, methods=["GET"]),
+        Route("/loop_stats", get_loop_stats, methods=["GET"]),
+        Route("/metrics", metrics, methods=["GET"]),
+        Route("/traces", get_traces, methods=["GET"]),
+        Route("/traces/{trace_id}", get_trace, methods=["GET"]),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=["*"], allow_headers=["*"]),
+    ],
+    lifespan=lifespan,
+)
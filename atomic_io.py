@@ -0,0 +1,32 @@
+import os
+import json
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(file_path: str, mode: str = 'w'):
+    """
+    Opens a temporary file next to file_path, swapped in with os.replace when the block succeeds.
+
+    Readers & interrupted runs never see a truncated file, the previous one stays until the new one is complete.
+    """
+    os.makedirs(os.path.dirname(file_path) or ".", exist_ok=True)
+    tmp_file_path = file_path + ".tmp"
+    try:
+        with open(tmp_file_path, mode, **({} if 'b' in mode else {"encoding": "utf-8"})) as f:
+            yield f
+        os.replace(tmp_file_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_file_path):
+            os.remove(tmp_file_path)
+        raise
+
+
+def write_text_atomically(file_path: str, text: str):
+    with atomic_write(file_path) as f:
+        f.write(text)
+
+
+def write_json_atomically(file_path: str, data, **dump_kwargs):
+    with atomic_write(file_path) as f:
+        json.dump(data, f, **dump_kwargs)
@@ -0,0 +1,124 @@
+"""
+End-to-end graph benchmark without network access.
+
+Ingests synthetic chapters into an in-memory Qdrant, replaces Groq, Tavily, Qdrant & INSTRUCTOR with the
+deterministic fakes of benchmarks.fakes (latency per call is configurable) and runs the question set through
+the compiled graph. Reports throughput, request latency & per node latency, runs and LLM calls:
+
+    python -m benchmarks.bench_e2e --requests 64 --concurrency 8 --llm-latency 0.2 --search-latency 0.01
+"""
+import io
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+from contextlib import redirect_stdout, nullcontext
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks import fakes
+
+COLLECTION_NAME = "bench_e2e"
+
+
+def ingest_corpus(subjects: int):
+    from langchain_core.documents import Document
+    from qdrant_manager import QdrantManager
+
+    qdrant_manager = QdrantManager(COLLECTION_NAME)
+    qdrant_manager.create_vector_collection()
+    chunks = [
+        Document(page_content=paragraph, metadata={"subject": paragraph.split(" (", 1)[0]})
+        for paragraph in fakes.synthetic_markdown(subjects).split("\n") if paragraph and not paragraph.startswith("#")
+    ]
+    qdrant_manager.populate_vector_collection("bench_chapter", "Features of", chunks)
+
+
+def answer(question: str) -> dict:
+    from agent_service import build_inputs
+    from graph_workflow import agent
+    from tracing import RequestTrace, trace_config
+
+    trace = RequestTrace(question, COLLECTION_NAME)
+    results = agent.invoke(build_inputs(question, COLLECTION_NAME), config=trace_config(trace))
+    trace.finish()
+    return {"results": results, "trace": trace.to_dict()}
+
+
+def print_report(runs: list[dict], elapsed: float):
+    from agent_service import LoopStats
+    from benchmarks.bench_serving import percentile
+
+    latencies = [run["trace"]["wall_ms"] for run in runs]
+    loop_stats = LoopStats()
+    for run in runs:
+        loop_stats.record(run["results"])
+    loops = loop_stats.stats()
+    print(f"{len(runs)} questions in {elapsed:.2f}s | {len(runs) / elapsed:.2f} questions/s | "
+          f"p50 {percentile(latencies, 50):.1f}ms | p95 {percentile(latencies, 95):.1f}ms | "
+          f"p99 {percentile(latencies, 99):.1f}ms")
+    print(f"LLM calls/question {statistics.mean(run['trace']['llm_calls'] for run in runs):.2f} | "
+          f"avg query corrections {loops['avg_query_corrections']:.2f} | web search rate {loops['web_search_rate']:.2f}")
+    print(f"context tokens saved/question {statistics.mean(run['trace']['context_tokens_saved'] for run in runs):.0f}")
+    decisions = Counter(f"{decision['decision']} ({decision['reason']})"
+                        for run in runs for decision in run["trace"]["decisions"])
+    print("decisions/question: " + ", ".join(f"{name} {count / len(runs):.2f}"
+                                             for name, count in decisions.most_common()))
+
+    spans_by_node = defaultdict(list)
+    for run in runs:
+        for span in run["trace"]["spans"]:
+            spans_by_node[span["node"]].append(span)
+    print(f"{'node':>20} | runs/q | p50 ms | p95 ms | embed ms | search ms | LLM calls/q | tokens/q")
+    for node, spans in spans_by_node.items():
+        walls = [span["wall_ms"] for span in spans]
+        tokens = sum(span["prompt_tokens"] + span["completion_tokens"] for span in spans)
+        print(f"{node:>20} | {len(spans) / len(runs):6.2f} | {percentile(walls, 50):6.1f} | "
+              f"{percentile(walls, 95):6.1f} | {statistics.mean(span['embed_ms'] for span in spans):8.2f} | "
+              f"{statistics.mean(span['search_ms'] for span in spans):9.2f} | "
+              f"{sum(span['llm_calls'] for span in spans) / len(runs):11.2f} | {tokens / len(runs):8.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end graph benchmark with local fakes")
+    parser.add_argument("--requests", type=int, default=32)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--subjects", type=int, default=40, help="plant subjects in the synthetic corpus")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds per LLM call")
+    parser.add_argument("--llm-tokens-per-sec", type=float, default=800.0)
+    parser.add_argument("--web-latency", type=float, default=0.5, help="seconds per web search")
+    parser.add_argument("--search-latency", type=float, default=0.01, help="seconds per vector store round trip")
+    parser.add_argument("--embed-latency", type=float, default=0.02, help="seconds per embedding call")
+    parser.add_argument("--questions-file", help="file with one question per line")
+    parser.add_argument("--verbose", action="store_true", help="keep the progress prints of graph nodes")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_e2e_")
+    fakes.use_local_environment(work_dir)
+    try:
+        from benchmarks.bench_search import MORE_QUESTIONS
+        from benchmarks.bench_serving import DEFAULT_QUESTIONS
+
+        fakes.install_fakes(COLLECTION_NAME, llm_latency=args.llm_latency,
+                            llm_tokens_per_second=args.llm_tokens_per_sec, web_latency=args.web_latency,
+                            search_latency=args.search_latency, embed_latency=args.embed_latency)
+        ingest_corpus(args.subjects)
+
+        questions = DEFAULT_QUESTIONS + MORE_QUESTIONS
+        if args.questions_file:
+            with open(args.questions_file, 'r', encoding="utf-8") as f:
+                questions = [line.strip() for line in f if line.strip()]
+        jobs = [questions[i % len(questions)] for i in range(args.requests)]
+
+        start = time.perf_counter()
+        with nullcontext() if args.verbose else redirect_stdout(io.StringIO()):
+            with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+                runs = list(executor.map(answer, jobs))
+        print_report(runs, time.perf_counter() - start)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
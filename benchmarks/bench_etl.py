@@ -0,0 +1,83 @@
+"""
+ETL benchmark on synthetic chapter markdown without network access.
+
+Writes a large chapter in the layout of the encyclopedia parts, then times MarkdownDocsExtractor (with its peak
+Python memory) and populate_vector_collection into an in-memory Qdrant with the fake INSTRUCTOR model
+of benchmarks.fakes, followed by a re-run over the unchanged chapter:
+
+    python -m benchmarks.bench_etl --subjects 2000 --embed-latency 0.05 --search-latency 0.005
+"""
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+from benchmarks import fakes
+
+COLLECTION_NAME = "bench_etl"
+CHAPTER_NAME = "bench_synthetic_chapter"
+
+
+def extract_chunks(extraction: str, groups: dict) -> tuple[list, float, float]:
+    from markdown_docs_extractor import MarkdownDocsExtractor
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    md_docs_extractor = MarkdownDocsExtractor(input_file=CHAPTER_NAME)
+    if extraction == "categories":
+        doc_chunks = list(md_docs_extractor.extract_docs_by_categories(groups))
+    else:
+        doc_chunks = list(md_docs_extractor.extract_docs())
+    elapsed = time.perf_counter() - start
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return doc_chunks, elapsed, peak_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ETL benchmark on synthetic markdown with local fakes")
+    parser.add_argument("--subjects", type=int, default=1000, help="plant subjects in the synthetic chapter")
+    parser.add_argument("--paragraphs", type=int, default=3, help="paragraphs per section")
+    parser.add_argument("--extraction", choices=["categories", "default"], default="categories")
+    parser.add_argument("--embed-latency", type=float, default=0.0, help="seconds per embedding call")
+    parser.add_argument("--search-latency", type=float, default=0.0, help="seconds per vector store round trip")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="bench_etl_")
+    fakes.use_local_environment(work_dir)
+    cwd = os.getcwd()
+    try:
+        # the extractor reads chapters from ./data_store
+        os.makedirs(os.path.join(work_dir, "data_store"))
+        with open(os.path.join(work_dir, "data_store", f"{CHAPTER_NAME}.md"), 'w', encoding="utf-8") as f:
+            f.write(fakes.synthetic_markdown(args.subjects, args.paragraphs))
+        markdown_mb = os.path.getsize(os.path.join(work_dir, "data_store", f"{CHAPTER_NAME}.md")) / 1024 ** 2
+        os.chdir(work_dir)
+
+        from etl_script import groups_mapper, other_medicinal_plants
+        from qdrant_manager import QdrantManager
+
+        fakes.install_fakes(COLLECTION_NAME, search_latency=args.search_latency, embed_latency=args.embed_latency)
+        doc_chunks, extract_seconds, peak_bytes = extract_chunks(args.extraction, groups_mapper[other_medicinal_plants])
+
+        qdrant_manager = QdrantManager(COLLECTION_NAME)
+        qdrant_manager.create_vector_collection()
+        ingest_stats = qdrant_manager.populate_vector_collection(CHAPTER_NAME, "Features of", doc_chunks)
+        rerun_stats = qdrant_manager.populate_vector_collection(CHAPTER_NAME, "Features of", doc_chunks)
+
+        print(f"chapter: {args.subjects} subjects, {markdown_mb:.2f} MB markdown")
+        print(f"extract: {len(doc_chunks)} chunks in {extract_seconds:.2f}s "
+              f"({markdown_mb / extract_seconds if extract_seconds else 0.0:.2f} MB/s), "
+              f"peak Python memory {peak_bytes / 1024 ** 2:.1f} MB")
+        print(f" ingest: {ingest_stats['chunks']} chunks in {ingest_stats['seconds']:.2f}s "
+              f"({ingest_stats['chunks_per_sec']:.1f} chunks/s), {ingest_stats['failed']} failed")
+        print(f" re-run: {rerun_stats['chunks']} chunks re-embedded in {rerun_stats['seconds']:.2f}s")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
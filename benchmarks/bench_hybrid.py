@@ -0,0 +1,42 @@
+"""
+Query correction loops per question with dense-only vs hybrid (dense + BM25) retrieval.
+
+Runs the question set through the compiled graph twice, with the answer cache off, and reports the average
+number of transform_query -> retrieve loops, their distribution & the web search fallback rate:
+
+    python -m benchmarks.bench_hybrid --collection medical_herbs_rag_instructor_embeddings
+"""
+import argparse
+
+from agent_service import LoopStats, build_inputs
+from benchmarks.bench_search import MORE_QUESTIONS
+from benchmarks.bench_serving import DEFAULT_QUESTIONS
+from graph_workflow import agent
+
+
+def run_questions(questions: list[str], collection_name: str, hybrid: bool) -> dict:
+    stats = LoopStats()
+    for question in questions:
+        stats.record(agent.invoke(build_inputs(question, collection_name, hybrid_search=hybrid)))
+    return stats.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query correction loops, dense vs hybrid retrieval")
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--questions-file", help="file with one question per line")
+    args = parser.parse_args()
+
+    questions = DEFAULT_QUESTIONS + MORE_QUESTIONS
+    if args.questions_file:
+        with open(args.questions_file, 'r', encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+
+    for name, hybrid in (("dense", False), ("hybrid", True)):
+        stats = run_questions(questions, args.collection, hybrid)
+        print(f"{name:>8} | avg loops {stats['avg_query_corrections']:.2f} | loops {stats['query_corrections']} | "
+              f"web search rate {stats['web_search_rate']:.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Golden output check & throughput of transform_text_to_markdown.
+
+Compares the markdown of the encyclopedia parts' text caches (./data_store/*.txt) and of generated texts
+with edge cases against the previous two-pass regex transformer, then reports MB/s of both. Exits with 1
+when any output differs:
+
+    python -m benchmarks.bench_markdown --repeats 5
+    python -m benchmarks.bench_markdown --files "./data_store/Encyclopedia of Herbal Medicine_part_4*.txt"
+"""
+import re
+import sys
+import glob
+import time
+import random
+import argparse
+
+from pdf_parser_utils import transform_text_to_markdown, DOUBLE_HASH_TERMS
+
+
+def reference_transform_text_to_markdown(text: str):
+    # the previous implementation, kept as the golden reference
+    double_hash_pattern = r'\b(?:' + '|'.join(re.escape(term) for term in DOUBLE_HASH_TERMS) + r')\b'
+    d_str = "Description"
+    d_pattern = r'\n*([^.]*)\bDescription\b'
+    s = re.sub(d_pattern, lambda m: '\n# ' + m.group().replace('\n', ' ').replace(d_str, "\n## " + d_str + "\n"), text)
+    s = re.sub(double_hash_pattern, r'## \g<0>\n', s)
+    return s
+
+
+def generated_texts(count: int, seed: int = 0) -> list[str]:
+    """Random texts mixing plant entries with tricky spots: words glued to 'Description', dots, newlines..."""
+    rng = random.Random(seed)
+    pieces = [
+        "Description", "Descriptions", "XDescription", "Description_", "DescriptionDescription", " ", " ", "\n", "\n\n",
+        ".", ". ", "Garlic", "Allium sativum", "ALLIUM SATIVUM", "Research", "Researcher", "Caution", "Cautions",
+        "RQCaution", "Habitat & Cultivation", "Habitat &\nCultivation", "Parts Used", "Part Used", "Self-help Use",
+        "Self-help Uses", "Medicinal Actions & Uses", "Related Species", "Constituents", "Parts\nUsed", "ł", "é", "_",
+        "1.5", "e.g.", "History & Folklore",
+    ]
+    return ["".join(rng.choice(pieces) for _ in range(rng.randint(1, 400))) for _ in range(count)]
+
+
+def encyclopedia_entries(entries: int) -> str:
+    """Text shaped like the PyMuPDF output of the 4th part."""
+    rng = random.Random(1)
+    words = "leaves root flowers used remedy traditional infusion digestive tonic grows europe asia".split()
+    entry_parts = []
+    for entry in range(entries):
+        sentences = [" ".join(rng.choice(words) for _ in range(rng.randint(5, 20))).capitalize() + "."
+                     for _ in range(rng.randint(3, 8))]
+        entry_parts.append(
+            f"\nPLANT {entry}\nPlant {entry} (Latinus nominus {entry})\nDescription {sentences[0]}\n"
+            f"Habitat & Cultivation {' '.join(sentences[1:3])}\nParts Used {sentences[-1]}\n"
+            f"Constituents {sentences[0]}\nMedicinal Actions & Uses {' '.join(sentences)}\nCaution {sentences[1]}\n"
+        )
+    return "".join(entry_parts)
+
+
+def throughput(transform, text: str, repeats: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeats):
+        transform(text)
+    elapsed = time.perf_counter() - start
+    return len(text.encode("utf-8")) * repeats / 1024 ** 2 / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="transform_text_to_markdown golden check & throughput")
+    parser.add_argument("--files", default="./data_store/*.txt", help="glob of text files to transform")
+    parser.add_argument("--generated", type=int, default=2000, help="number of generated edge case texts")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    texts = {path: open(path, 'r', encoding="utf-8").read() for path in sorted(glob.glob(args.files))}
+    if not texts:
+        print(f"no files matching {args.files}, using generated encyclopedia text")
+        texts = {"generated encyclopedia": encyclopedia_entries(3000)}
+
+    mismatches = [name for name, text in texts.items()
+                  if transform_text_to_markdown(text) != reference_transform_text_to_markdown(text)]
+    mismatches += [f"generated #{i}" for i, text in enumerate(generated_texts(args.generated))
+                   if transform_text_to_markdown(text) != reference_transform_text_to_markdown(text)]
+    print(f"golden check: {len(texts) + args.generated - len(mismatches)}/{len(texts) + args.generated} identical")
+    for name in mismatches:
+        print(f"  output differs: {name}")
+
+    print(f"{'text':>40} |     MB | reference MB/s | MB/s")
+    for name, text in texts.items():
+        print(f"{name[-40:]:>40} | {len(text.encode('utf-8')) / 1024 ** 2:6.2f} | "
+              f"{throughput(reference_transform_text_to_markdown, text, args.repeats):14.2f} | "
+              f"{throughput(transform_text_to_markdown, text, args.repeats):4.2f}")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+Memory, latency & top-k overlap of quantized collections against the float32 baseline.
+
+Copies the points of a populated collection into temporary scalar (int8) and binary quantized collections,
+then runs the question set against all of them (needs the Qdrant vector store backend):
+
+    python -m benchmarks.bench_quantization --collection medical_herbs_rag_instructor_embeddings --k 8
+"""
+import time
+import argparse
+
+from qdrant_client import models
+
+from benchmarks.bench_search import MORE_QUESTIONS, time_searches, recall
+from benchmarks.bench_serving import DEFAULT_QUESTIONS, percentile
+from qdrant_manager import QdrantManager, build_search_params, batched, HNSW_EF, UPSERT_BATCH_SIZE
+
+# bytes per vector dimension kept in RAM for the search
+RAM_BYTES_PER_DIM = {"float32": 4.0, "scalar": 1.0, "binary": 1 / 8}
+
+
+def copy_points(source: QdrantManager, target: QdrantManager):
+    offset = None
+    while True:
+        records, offset = source.vector_store.client.scroll(
+            collection_name=source.collection_name,
+            limit=UPSERT_BATCH_SIZE,
+            offset=offset,
+            with_payload=True,
+            with_vectors=True
+        )
+        for records_batch in batched(records, UPSERT_BATCH_SIZE):
+            target.vector_store.client.upsert(
+                collection_name=target.collection_name,
+                points=[models.PointStruct(id=r.id, payload=r.payload, vector=r.vector) for r in records_batch],
+                wait=True
+            )
+        if offset is None:
+            break
+
+
+def wait_for_index(qdrant_manager: QdrantManager, timeout: float = 600.0):
+    start = time.perf_counter()
+    while time.perf_counter() - start < timeout:
+        info = qdrant_manager.vector_store.client.get_collection(qdrant_manager.collection_name)
+        if info.status == models.CollectionStatus.GREEN:
+            return
+        time.sleep(1.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantized collections vs float32 baseline")
+    parser.add_argument("--collection", required=True, help="populated float32 collection")
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=10, help="searches per question & collection")
+    parser.add_argument("--oversampling", type=float, default=2.0)
+    parser.add_argument("--keep", action="store_true", help="don't delete the quantized copies")
+    args = parser.parse_args()
+
+    baseline_manager = QdrantManager(args.collection)
+    info = baseline_manager.vector_store.client.get_collection(args.collection)
+    points_count = info.points_count
+    dim = info.config.params.vectors.size
+    vectors = [baseline_manager.embed_query(question) for question in DEFAULT_QUESTIONS + MORE_QUESTIONS]
+
+    baseline, latencies = time_searches(baseline_manager, vectors, args.k,
+                                        build_search_params("exact", HNSW_EF, 1.0), args.repeats)
+    rows = [("float32 exact", "float32", 1.0, latencies)]
+
+    for quantization in ("scalar", "binary"):
+        manager = QdrantManager(f"{args.collection}_bench_{quantization}")
+        try:
+            manager.create_vector_collection(quantization=quantization)
+            # small collections stay unindexed (and unquantized) below the default threshold
+            manager.vector_store.client.update_collection(
+                collection_name=manager.collection_name,
+                optimizer_config=models.OptimizersConfigDiff(indexing_threshold=1)
+            )
+            copy_points(baseline_manager, manager)
+            wait_for_index(manager)
+            for rescore in (False, True):
+                search_params = build_search_params("quantized", HNSW_EF, args.oversampling if rescore else 1.0)
+                search_params.quantization.rescore = rescore
+                results, latencies = time_searches(manager, vectors, args.k, search_params, args.repeats)
+                rows.append((f"{quantization}{' rescored' if rescore else ''}", quantization,
+                             recall(baseline, results), latencies))
+        finally:
+            if not args.keep:
+                manager.vector_store.client.delete_collection(manager.collection_name)
+
+    print(f"{points_count} points x {dim} dims")
+    print(f"{'collection':>18} | search RAM MB | top-{args.k} overlap | p50 ms | p95 ms")
+    for name, storage, overlap, latencies in rows:
+        ram_mb = points_count * dim * RAM_BYTES_PER_DIM[storage] / 1024 ** 2
+        print(f"{name:>18} | {ram_mb:13.2f} | {overlap:13.3f} | {percentile(latencies, 50) * 1000:6.2f} | "
+              f"{percentile(latencies, 95) * 1000:6.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Recall vs latency of Qdrant search modes.
+
+Runs the question set against a populated collection with the exact (brute force) search as the baseline
+and reports recall@k & p50/p95 latency of HNSW search with several ef values and of quantized search
+with several oversampling factors, so a search setting can be chosen per collection:
+
+    python -m benchmarks.bench_search --collection medical_herbs_rag_instructor_embeddings --k 8 --repeats 20
+"""
+import time
+import argparse
+import statistics
+
+from benchmarks.bench_serving import DEFAULT_QUESTIONS, percentile
+from qdrant_manager import QdrantManager, build_search_params, HNSW_EF
+
+MORE_QUESTIONS = [
+    "What is Hypericum perforatum?",
+    "Which plants contain hypericin?",
+    "How were herbs used in traditional Chinese medicine?",
+    "What are the medicinal actions of peppermint?",
+    "How should I store dried herbs?",
+    "What is the history of herbal medicine in India?",
+    "Which herbs help with insomnia?",
+    "What are the cautions of using comfrey?",
+]
+
+
+def time_searches(qdrant_manager: QdrantManager, vectors: list, k: int, search_params, repeats: int):
+    latencies = []
+    results = []
+    for vector in vectors:
+        for _ in range(repeats):
+            start = time.perf_counter()
+            points = qdrant_manager.search(vector, limit=k, search_params=search_params)
+            latencies.append(time.perf_counter() - start)
+        results.append([point.id for point in points])
+    return results, latencies
+
+
+def recall(baseline: list[list], results: list[list]) -> float:
+    scores = [len(set(expected) & set(found)) / len(expected) for expected, found in zip(baseline, results) if expected]
+    return statistics.mean(scores) if scores else 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Qdrant search modes recall vs latency")
+    parser.add_argument("--collection", required=True)
+    parser.add_argument("--k", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=10, help="searches per question & setting")
+    parser.add_argument("--ef", type=int, nargs="+", default=[16, 32, 64, 128, 256])
+    parser.add_argument("--oversampling", type=float, nargs="+", default=[1.0, 2.0, 4.0],
+                        help="quantized search settings, needs a collection created with quantization")
+    args = parser.parse_args()
+
+    qdrant_manager = QdrantManager(args.collection)
+    vectors = [qdrant_manager.embed_query(question) for question in DEFAULT_QUESTIONS + MORE_QUESTIONS]
+
+    settings = [("exact", build_search_params("exact", HNSW_EF, 1.0))]
+    settings += [(f"hnsw ef={ef}", build_search_params("hnsw", ef, 1.0)) for ef in args.ef]
+    settings += [(f"quantized x{oversampling}", build_search_params("quantized", HNSW_EF, oversampling))
+                 for oversampling in args.oversampling]
+
+    baseline = None
+    print(f"{'setting':>18} | recall@{args.k} | p50 ms | p95 ms")
+    for name, search_params in settings:
+        results, latencies = time_searches(qdrant_manager, vectors, args.k, search_params, args.repeats)
+        baseline = baseline or results
+        print(f"{name:>18} | {recall(baseline, results):8.3f} | {percentile(latencies, 50) * 1000:6.2f} | "
+              f"{percentile(latencies, 95) * 1000:6.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Near-miss check of the semantic answer cache.
+
+Embeds question pairs the way the API does (INSTRUCTOR query vectors) and reports their cosine distance & whether
+the answer cache would serve the first question's answer for the second one. Pairs about different herbs must
+never be merged, so the command exits with status 1 when one is, paraphrases of the same question should be:
+
+    python -m benchmarks.bench_semantic_cache --max-distance 0.01
+
+--offline uses the hashed bag-of-words fake of benchmarks.fakes instead of the INSTRUCTOR model.
+"""
+import sys
+import argparse
+import tempfile
+
+from benchmarks import fakes
+
+# same question about two different herbs
+NEAR_MISS_PAIRS = [
+    ("What is garlic used for?", "What is ginger used for?"),
+    ("How to grow garlic?", "How to grow ginseng?"),
+    ("What are the side effects of chamomile?", "What are the side effects of comfrey?"),
+    ("Which constituents does peppermint contain?", "Which constituents does spearmint contain?"),
+    ("Can St John's wort help with depression?", "Can lavender help with depression?"),
+    ("What are the cautions of using comfrey?", "What are the cautions of using feverfew?"),
+    ("Is valerian safe during pregnancy?", "Is echinacea safe during pregnancy?"),
+    ("What are the medicinal actions of ginkgo?", "What are the medicinal actions of ginger?"),
+]
+# same question asked differently
+PARAPHRASE_PAIRS = [
+    ("What is garlic used for?", "What is garlic used for"),
+    ("How to grow garlic?", "How do I grow garlic?"),
+    ("What are the side effects of chamomile?", "What side effects does chamomile have?"),
+    ("Which herbs help with insomnia?", "Which herbs help with sleeplessness?"),
+]
+
+
+def check_pairs(answer_cache, model, pairs: list[tuple[str, str]]) -> list[tuple[str, str, float, bool]]:
+    from qdrant_manager import QUERY_INSTRUCTION
+
+    results = []
+    for i, (first, second) in enumerate(pairs):
+        vectors = model.encode([f'{QUERY_INSTRUCTION} """ {question} """' for question in (first, second)])
+        collection_name = f"pair_{i}"
+        answer_cache.store(collection_name, vectors[0], {"generation": first, "documents": []})
+        merged = answer_cache.lookup(collection_name, vectors[1]) is not None
+        first_vector, second_vector = (answer_cache._normalize(vector) for vector in vectors)
+        results.append((first, second, 1.0 - float(first_vector @ second_vector), merged))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Semantic answer cache merges of near-miss & paraphrased questions")
+    parser.add_argument("--max-distance", type=float, help="cache max cosine distance (default: the configured one)")
+    parser.add_argument("--offline", action="store_true", help="use the fake embedding model")
+    args = parser.parse_args()
+
+    if args.offline:
+        fakes.use_local_environment(tempfile.mkdtemp(prefix="bench_semantic_cache_"))
+    from resource_pool import resource_pool
+    from semantic_cache import SemanticCache, answer_cache as configured_cache
+
+    model = fakes.FakeInstructor() if args.offline else resource_pool.get_embedding_model()
+    max_distance = configured_cache.max_distance if args.max_distance is None else args.max_distance
+    answer_cache = SemanticCache(max_distance=max_distance, ttl=3600, max_entries=len(NEAR_MISS_PAIRS))
+
+    near_misses = check_pairs(answer_cache, model, NEAR_MISS_PAIRS)
+    paraphrases = check_pairs(answer_cache, model, PARAPHRASE_PAIRS)
+    print(f"max distance {max_distance}")
+    for title, results in (("near misses (must not merge)", near_misses), ("paraphrases", paraphrases)):
+        print(title)
+        for first, second, distance, merged in results:
+            print(f"  {distance:.4f} {'merged' if merged else 'apart '}  {first!r} / {second!r}")
+    wrongly_merged = sum(merged for *_, merged in near_misses)
+    print(f"{wrongly_merged}/{len(near_misses)} near misses merged, "
+          f"{sum(merged for *_, merged in paraphrases)}/{len(paraphrases)} paraphrases served from the cache")
+    sys.exit(1 if wrongly_merged else 0)
+
+
+if __name__ == "__main__":
+    main()
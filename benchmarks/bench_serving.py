@@ -0,0 +1,104 @@
+"""
+Load test of the answer endpoint.
+
+Fires the same question set at one or more running servers with a fixed number of concurrent clients
+and reports requests/sec and p50/p95/p99 latency for each of them, e.g. the Flask app from a checkout compiling
+the graph per request (before) vs the ASGI app (after):
+
+    flask run --port 5000
+    uvicorn asgi_app:app --port 8000
+    python -m benchmarks.bench_serving --target flask=http://localhost:5000 --target asgi=http://localhost:8000 \
+        --collection medical_herbs_rag_instructor_embeddings --requests 200 --concurrency 32
+"""
+import time
+import argparse
+import statistics
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_QUESTIONS = [
+    "What is St John's wort used for?",
+    "How was garlic used in ancient Egypt?",
+    "What are the key constituents of chamomile?",
+    "Are there any cautions for taking ginkgo?",
+    "How do I prepare a valerian infusion?",
+    "Which parts of echinacea are used medicinally?",
+    "What are the traditional uses of ginger?",
+    "Where is licorice cultivated?",
+]
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def send_request(base_url: str, question: str, collection_name: str, timeout: float) -> tuple[float, bool]:
+    url = f"{base_url.rstrip('/')}/get_answer/{urllib.parse.quote(question, safe='')}"
+    req = urllib.request.Request(url, headers={"Collection-Name": collection_name})
+    start = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as response:
+            response.read()
+            ok = response.status == 200
+    except Exception:
+        ok = False
+    return time.perf_counter() - start, ok
+
+
+def run_load(base_url: str, questions: list[str], collection_name: str, requests_count: int, concurrency: int,
+             timeout: float) -> dict:
+    jobs = [questions[i % len(questions)] for i in range(requests_count)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda q: send_request(base_url, q, collection_name, timeout), jobs))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for latency, ok in results if ok]
+    errors = sum(1 for _, ok in results if not ok)
+    if not latencies:
+        return {"requests": requests_count, "errors": errors, "rps": 0.0}
+    return {
+        "requests": requests_count,
+        "errors": errors,
+        "rps": len(latencies) / elapsed,
+        "mean": statistics.mean(latencies),
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+    }
+
+
+def print_report(name: str, stats: dict):
+    if "p50" not in stats:
+        print(f"{name:>12} | all {stats['requests']} requests failed")
+        return
+    print(f"{name:>12} | {stats['rps']:8.2f} req/s | p50 {stats['p50']:7.3f}s | p95 {stats['p95']:7.3f}s | "
+          f"p99 {stats['p99']:7.3f}s | errors {stats['errors']}/{stats['requests']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Answer endpoint load test")
+    parser.add_argument("--target", action="append", required=True,
+                        help="name=base_url of a running server, may be repeated")
+    parser.add_argument("--collection", required=True, help="value of the Collection-Name header")
+    parser.add_argument("--questions-file", help="file with one question per line")
+    parser.add_argument("--requests", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--timeout", type=float, default=120.0)
+    args = parser.parse_args()
+
+    questions = DEFAULT_QUESTIONS
+    if args.questions_file:
+        with open(args.questions_file, 'r', encoding="utf-8") as f:
+            questions = [line.strip() for line in f if line.strip()]
+
+    for target in args.target:
+        name, base_url = target.split("=", 1)
+        stats = run_load(base_url, questions, args.collection, args.requests, args.concurrency, args.timeout)
+        print_report(name, stats)
+
+
+if __name__ == "__main__":
+    main()
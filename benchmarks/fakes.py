@@ -0,0 +1,294 @@
+"""
+Deterministic local stand-ins for Groq, Tavily, Qdrant & INSTRUCTOR with configurable latency.
+
+use_local_environment() must run before the repo modules are imported, it points every store & cache
+at a scratch directory. install_fakes() then swaps the LLM chains, web search & embedding model of the graph
+and gives the collection an in-memory Qdrant client, so the QdrantVectorStore code path runs without a server.
+"""
+import os
+import re
+import time
+import random
+import hashlib
+import threading
+from typing import Any, Callable, Iterator, List, Optional
+
+import numpy as np
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def words(text: str) -> list[str]:
+    return WORD_PATTERN.findall(text.lower())
+
+
+def use_local_environment(work_dir: str):
+    os.makedirs(work_dir, exist_ok=True)
+    os.environ.update({
+        "VECTOR_STORE_BACKEND": "qdrant",
+        "SPARSE_INDEX_DIR": os.path.join(work_dir, "sparse_index"),
+        "INGEST_MANIFEST_DIR": os.path.join(work_dir, "manifests"),
+        "COLLECTION_VERSIONS_FILE": os.path.join(work_dir, "collection_versions.json"),
+        # every question has to go through the graph
+        "SEMANTIC_CACHE_ENABLED": "false",
+        "GROQ_KEY": os.getenv("GROQ_KEY", "fake"),
+        "TAVILY_API_KEY": os.getenv("TAVILY_API_KEY", "fake"),
+    })
+    os.environ.pop("EMBEDDING_CACHE_DISK_PATH", None)
+
+
+class FakeInstructor:
+    """
+    Hashed bag-of-words embeddings shaped like INSTRUCTOR ones.
+
+    Every text shares a common component, so unrelated texts score around 0.7 cosine similarity and texts
+    with the same words close to 1.0, like the 0.8 retrieval threshold expects.
+    """
+
+    def __init__(self, dim: int = 768, call_latency: float = 0.0, item_latency: float = 0.0):
+        self.dim = dim
+        self.call_latency = call_latency
+        self.item_latency = item_latency
+        self._common = self._unit_vector("\x00common")
+        self._word_vectors = {}
+        self._lock = threading.Lock()
+
+    def encode(self, sentences, batch_size: int = 32, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        time.sleep(self.call_latency + self.item_latency * len(texts))
+        vectors = np.stack([self._embed(text) for text in texts])
+        return vectors[0] if single else vectors
+
+    def _embed(self, text: str) -> np.ndarray:
+        # only the quoted text counts, not the INSTRUCTOR instruction around it
+        parts = text.split('"""')
+        bag = np.zeros(self.dim, dtype=np.float32)
+        for word in words(parts[1] if len(parts) > 2 else text):
+            bag += self._word_vector(word)
+        norm = np.linalg.norm(bag)
+        if not norm:
+            return self._common
+        vector = np.sqrt(0.7) * self._common + np.sqrt(0.3) * bag / norm
+        return vector / np.linalg.norm(vector)
+
+    def _word_vector(self, word: str) -> np.ndarray:
+        vector = self._word_vectors.get(word)
+        if vector is None:
+            vector = self._unit_vector(word)
+            with self._lock:
+                self._word_vectors[word] = vector
+        return vector
+
+    def _unit_vector(self, seed_text: str) -> np.ndarray:
+        seed = int.from_bytes(hashlib.md5(seed_text.encode("utf-8")).digest()[:8], "little")
+        vector = np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+
+class FakeChatGroq(BaseChatModel):
+    """
+    Chat model answering with respond(last message text) after latency + completion tokens / tokens_per_second.
+
+    Calls taking longer than timeout fail with TimeoutError after timeout seconds, like a Groq request timeout.
+    """
+
+    respond: Callable[[str], str]
+    latency: float = 0.0
+    tokens_per_second: float = 0.0
+    timeout: Optional[float] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat-groq"
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None,
+                  **kwargs) -> ChatResult:
+        text, token_usage, generation_time = self._respond(messages)
+        time.sleep(self.latency + generation_time)
+        return ChatResult(
+            generations=[ChatGeneration(message=AIMessage(content=text))],
+            llm_output={"token_usage": token_usage}
+        )
+
+    def _stream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None, run_manager: Any = None,
+                **kwargs) -> Iterator[ChatGenerationChunk]:
+        # one chunk per word, paced by tokens_per_second, the last one carries the usage like Groq's final chunk
+        text, token_usage, generation_time = self._respond(messages)
+        time.sleep(self.latency)
+        tokens = re.findall(r"\S+\s*", text)
+        usage_metadata = {"input_tokens": token_usage["prompt_tokens"],
+                          "output_tokens": token_usage["completion_tokens"],
+                          "total_tokens": token_usage["total_tokens"]}
+        for i, token in enumerate(tokens):
+            time.sleep(generation_time / len(tokens))
+            chunk = ChatGenerationChunk(message=AIMessageChunk(
+                content=token, usage_metadata=usage_metadata if i == len(tokens) - 1 else None
+            ))
+            if run_manager:
+                run_manager.on_llm_new_token(token, chunk=chunk)
+            yield chunk
+
+    def _respond(self, messages: List[BaseMessage]) -> tuple[str, dict, float]:
+        text = self.respond(messages[-1].content)
+        prompt_tokens = sum(len(words(message.content)) for message in messages)
+        completion_tokens = len(words(text))
+        generation_time = completion_tokens / self.tokens_per_second if self.tokens_per_second else 0.0
+        if self.timeout is not None and self.latency + generation_time > self.timeout:
+            time.sleep(self.timeout)
+            raise TimeoutError(f"Request timed out after {self.timeout}s")
+        token_usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                       "total_tokens": prompt_tokens + completion_tokens}
+        return text, token_usage, generation_time
+
+
+def grade_response(message: str) -> str:
+    # relevant when the document shares at least a third of the question's keywords
+    document, _, question = message.partition("User question:")
+    question_words = {word for word in words(question) if len(word) > 3}
+    shared_words = question_words & set(words(document))
+    return "yes" if question_words and len(shared_words) * 3 >= len(question_words) else "no"
+
+
+def rewrite_response(message: str) -> str:
+    question = message.split("initial question:", 1)[-1].split("Formulate", 1)[0].strip()
+    return f"{question} medicinal herb uses"
+
+
+def generation_response(message: str) -> str:
+    return "Based on the provided sections: " + " ".join(words(message)[:120])
+
+
+def revision_response(message: str) -> str:
+    answer = message.split("And the answer:", 1)[-1]
+    return " ".join(answer.split()[:60])
+
+
+class FakeTavilySearchResults:
+    def __init__(self, latency: float = 0.0, max_results: int = 5):
+        self.latency = latency
+        self.max_results = max_results
+
+    def invoke(self, inputs: dict) -> list[dict]:
+        time.sleep(self.latency)
+        query = inputs["query"]
+        return [{
+            "url": f"https://example.org/{'-'.join(words(query)[:6])}/{rank}",
+            "content": f"Result {rank} about {query}. " + " ".join(words(query) * 20)
+        } for rank in range(self.max_results)]
+
+
+class SerializedClient:
+    """Runs one call of a client at a time, the in-memory QdrantClient isn't thread-safe like a Qdrant server."""
+
+    def __init__(self, client):
+        self.client = client
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if not callable(attribute):
+            return attribute
+
+        def serialized(*args, **kwargs):
+            with self._lock:
+                return attribute(*args, **kwargs)
+        return serialized
+
+
+class DelayedVectorStore:
+    """Adds a fixed round-trip latency to search & retrieve calls of a vector store, like a remote Qdrant."""
+
+    def __init__(self, vector_store, latency: float):
+        self.vector_store = vector_store
+        self.latency = latency
+
+    def search(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return self.vector_store.search(*args, **kwargs)
+
+    def search_batch(self, *args, **kwargs):
+        # a single round trip for all searches
+        time.sleep(self.latency)
+        return self.vector_store.search_batch(*args, **kwargs)
+
+    def retrieve(self, *args, **kwargs):
+        time.sleep(self.latency)
+        return self.vector_store.retrieve(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.vector_store, name)
+
+
+def install_fakes(collection_name: str, llm_latency: float = 0.0, llm_tokens_per_second: float = 0.0,
+                  web_latency: float = 0.0, search_latency: float = 0.0, embed_latency: float = 0.0):
+    """Replaces every remote dependency of the graph with a local fake, LLM calls & tokens still reach the traces."""
+    # repo modules read their configuration at import, so they're imported after use_local_environment()
+    import graph_nodes
+    import llm_chain_components as chains
+    from langchain_core.output_parsers import StrOutputParser
+    from qdrant_client import QdrantClient
+    from resource_pool import resource_pool
+    from vector_stores import QdrantVectorStore
+    from tracing import llm_usage_callback
+
+    resource_pool._model = FakeInstructor(call_latency=embed_latency)
+    client = SerializedClient(QdrantClient(location=":memory:"))
+    resource_pool._qdrant_clients[collection_name] = client
+    resource_pool._vector_stores[collection_name] = DelayedVectorStore(
+        QdrantVectorStore(collection_name, client), search_latency
+    )
+
+    llms = {
+        name: FakeChatGroq(respond=respond, latency=llm_latency, tokens_per_second=llm_tokens_per_second,
+                           timeout=timeout, callbacks=[llm_usage_callback])
+        for name, respond, timeout in (("rag", generation_response, None), ("grader", grade_response, None),
+                                       ("rewriter", rewrite_response, None),
+                                       ("reviser", revision_response, chains.REVISION_TIMEOUT))
+    }
+    graph_nodes.rag_chain = (chains.rag_prompt | llms["rag"] | StrOutputParser()).with_config(
+        tags=[chains.RAG_GENERATION_TAG]
+    )
+    graph_nodes.retrieval_grader = (chains.grade_prompt | llms["grader"]
+                                    | (lambda message: chains.DocsGrader(binary_score=message.content)))
+    graph_nodes.question_rewriter = chains.rewrite_prompt | llms["rewriter"] | StrOutputParser()
+    graph_nodes.answer_reviser = chains.revision_prompt | llms["reviser"] | StrOutputParser()
+    graph_nodes.TavilySearchResults = lambda: FakeTavilySearchResults(latency=web_latency)
+
+
+PLANTS = [
+    ("St John's wort", "Hypericum perforatum", "hypericin"),
+    ("Garlic", "Allium sativum", "allicin"),
+    ("Chamomile", "Matricaria recutita", "chamazulene"),
+    ("Ginkgo", "Ginkgo biloba", "ginkgolides"),
+    ("Valerian", "Valeriana officinalis", "valepotriates"),
+    ("Echinacea", "Echinacea purpurea", "alkamides"),
+    ("Ginger", "Zingiber officinale", "gingerols"),
+    ("Licorice", "Glycyrrhiza glabra", "glycyrrhizin"),
+    ("Peppermint", "Mentha x piperita", "menthol"),
+    ("Comfrey", "Symphytum officinale", "allantoin"),
+]
+SECTIONS = ["Description", "Habitat & Cultivation", "Parts Used", "Constituents", "Medicinal Actions & Uses",
+            "Caution", "Self-help Uses"]
+FILLER = ("plant leaves root flowers infusion tincture decoction traditionally used remedy digestive nervous "
+          "system inflammation herbalists europe asia grows soil summer harvested dried taken daily doses").split()
+
+
+def synthetic_markdown(subjects: int, paragraphs_per_section: int = 3, seed: int = 0) -> str:
+    """Chapter markdown in the layout of the encyclopedia parts: '# *Name* (Latin)' subjects with '##' sections."""
+    rng = random.Random(seed)
+    lines = []
+    for subject in range(subjects):
+        common_name, latin_name, constituent = PLANTS[subject % len(PLANTS)]
+        variant = f" {subject // len(PLANTS)}" if subject >= len(PLANTS) else ""
+        lines.append(f"# *{common_name}{variant}* ({latin_name})")
+        for section in SECTIONS:
+            lines.append(f"## {section}")
+            for _ in range(paragraphs_per_section):
+                filler = " ".join(rng.choice(FILLER) for _ in range(40))
+                lines.append(f"{common_name} ({latin_name}) contains {constituent}, {filler}.")
+                lines.append("")
+    return "\n".join(lines)
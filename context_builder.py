@@ -0,0 +1,130 @@
+import re
+from collections import defaultdict
+
+import numpy as np
+
+from relevance_filter import normalize_rows
+
+# rough token count of llama3 prompts, there's no local tokenizer of the Groq model
+CHARS_PER_TOKEN = 4
+SENTENCE_PATTERN = re.compile(r'(?<=[.!?])\s+|\s*\n+\s*')
+
+
+def estimate_tokens(text: str) -> int:
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def context_tokens(documents: list[dict]) -> int:
+    # the prompt gets the documents list as its string representation
+    return estimate_tokens(str(documents))
+
+
+def split_sentences(text: str, max_chars: int) -> list[str]:
+    """Splits text into sentences & lines, the ones longer than max_chars (e.g. without punctuation) into word runs."""
+    sentences = []
+    for sentence in SENTENCE_PATTERN.split(text):
+        sentence = sentence.strip()
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            cut = cut if cut > 0 else max_chars
+            sentences.append(sentence[:cut])
+            sentence = sentence[cut:].strip()
+        if sentence:
+            sentences.append(sentence)
+    return sentences
+
+
+def build_context(query_vector, documents: list[dict], embed_sentences, token_budget: int, doc_token_limit: int,
+                  duplicate_threshold: float = 0.95) -> tuple[list[dict], int, int]:
+    """
+    Compresses documents into the generation context of at most token_budget tokens.
+
+    Sentences repeated by overlapping chunks are kept only in the first document. When the context still doesn't
+    fit the budget or a document is over doc_token_limit, sentences are embedded & packed most relevant to the
+    question first, skipping near-duplicates of packed ones. Headers ("Garlic; Description:") come along with the
+    sentences under them. Documents keep their order, sources & the original order of their sentences.
+
+    Args:
+        query_vector: Embedding of the question
+        documents (list[dict]): Documents with content & source, most relevant first
+        embed_sentences: Function returning embeddings of a list of sentences
+        token_budget (int): Max estimated tokens of the whole context
+        doc_token_limit (int): Max estimated tokens of a single document
+        duplicate_threshold (float): Cosine similarity above which a sentence counts as a near-duplicate
+
+    Returns:
+        tuple: Context documents, estimated tokens of the documents & of the context
+    """
+    tokens_before = context_tokens(documents)
+    seen_sentences = set()
+    doc_sentences = []
+    for doc in documents:
+        sentences = []
+        for sentence in split_sentences(doc["content"], doc_token_limit * CHARS_PER_TOKEN // 2):
+            key = " ".join(sentence.lower().split())
+            if key not in seen_sentences:
+                seen_sentences.add(key)
+                sentences.append(sentence)
+        doc_sentences.append(sentences)
+
+    kept = [list(range(len(sentences))) for sentences in doc_sentences]
+    context = _assemble(documents, doc_sentences, kept)
+    if context_tokens(context) <= token_budget and \
+            all(estimate_tokens(doc["content"]) <= doc_token_limit for doc in context):
+        return context, tokens_before, context_tokens(context)
+
+    flat_sentences = [(doc_i, sentence_i) for doc_i, sentences in enumerate(doc_sentences)
+                      for sentence_i in range(len(sentences))]
+    vectors = normalize_rows(np.asarray(
+        embed_sentences([doc_sentences[doc_i][sentence_i] for doc_i, sentence_i in flat_sentences]), dtype=np.float32
+    ))
+    query = normalize_rows(np.asarray(query_vector, dtype=np.float32)[None, :])[0]
+    relevance = vectors @ query
+
+    kept = [set() for _ in documents]
+    packed_rows = []
+    doc_tokens = defaultdict(int)
+    used_tokens = context_tokens([])
+    for row in np.argsort(-relevance):
+        doc_i, sentence_i = flat_sentences[row]
+        if doc_sentences[doc_i][sentence_i].endswith(":"):
+            # headers are packed with the sentences under them only
+            continue
+        if packed_rows and float((vectors[packed_rows] @ vectors[row]).max()) >= duplicate_threshold:
+            continue
+        new_sentences = [sentence_i]
+        header_i = _header_of(doc_sentences[doc_i], sentence_i)
+        if header_i is not None and header_i not in kept[doc_i]:
+            new_sentences.append(header_i)
+        cost = sum(estimate_tokens(doc_sentences[doc_i][i]) + 1 for i in new_sentences)
+        if not kept[doc_i]:
+            cost += context_tokens([{"content": "", "source": documents[doc_i]["source"]}])
+        if doc_tokens[doc_i] + cost > doc_token_limit or used_tokens + cost > token_budget:
+            continue
+        kept[doc_i].update(new_sentences)
+        packed_rows.append(row)
+        doc_tokens[doc_i] += cost
+        used_tokens += cost
+
+    context = _assemble(documents, doc_sentences, [sorted(doc_kept) for doc_kept in kept])
+    return context, tokens_before, context_tokens(context)
+
+
+def _header_of(sentences: list[str], sentence_i: int):
+    for i in range(sentence_i - 1, -1, -1):
+        if sentences[i].endswith(":"):
+            return i
+    return None
+
+
+def _assemble(documents: list[dict], doc_sentences: list[list[str]], kept: list[list[int]]) -> list[dict]:
+    context = []
+    for doc, sentences, doc_kept in zip(documents, doc_sentences, kept):
+        if not doc_kept:
+            continue
+        content = ""
+        for i in doc_kept:
+            separator = "\n" if not content or content.endswith(":") or sentences[i].endswith(":") else " "
+            content += (separator if content else "") + sentences[i]
+        context.append({"content": content, "source": doc["source"]})
+    return context
@@ -0,0 +1,105 @@
+import os
+import dbm
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class EmbeddingCache:
+    """
+    LRU cache of INSTRUCTOR vectors keyed on instruction + text.
+
+    Memory use is bounded by max_vectors and max_bytes. With disk_path set, vectors are also kept
+    in a dbm file, so they survive restarts and memory evictions.
+    """
+
+    def __init__(self, max_vectors: int, max_bytes: int, disk_path: str = None):
+        self.max_vectors = max_vectors
+        self.max_bytes = max_bytes
+        self.disk_path = disk_path
+        self._lock = threading.Lock()
+        self._vectors = OrderedDict()
+        self._size_bytes = 0
+        self._disk = None
+        if disk_path:
+            os.makedirs(os.path.dirname(disk_path) or ".", exist_ok=True)
+            self._disk = dbm.open(disk_path, 'c')
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(instruction: str, text: str) -> str:
+        return hashlib.sha1(f"{instruction}\x00{text}".encode("utf-8")).hexdigest()
+
+    def get(self, instruction: str, text: str):
+        key = self.make_key(instruction, text)
+        with self._lock:
+            vector = self._vectors.get(key)
+            if vector is not None:
+                self._vectors.move_to_end(key)
+                self.hits += 1
+                return vector
+            if self._disk is not None and key in self._disk:
+                vector = np.frombuffer(self._disk[key], dtype=np.float32)
+                self._remember(key, vector)
+                self.disk_hits += 1
+                return vector
+            self.misses += 1
+            return None
+
+    def put(self, instruction: str, text: str, vector):
+        key = self.make_key(instruction, text)
+        vector = np.asarray(vector, dtype=np.float32)
+        with self._lock:
+            self._remember(key, vector)
+            if self._disk is not None:
+                self._disk[key] = vector.tobytes()
+
+    def get_or_compute(self, instruction: str, text: str, compute):
+        vector = self.get(instruction, text)
+        if vector is None:
+            vector = compute()
+            self.put(instruction, text, vector)
+        return vector
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.disk_hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits + self.disk_hits) / requests if requests else 0.0,
+                "vectors": len(self._vectors),
+                "bytes": self._size_bytes,
+            }
+
+    def close(self):
+        with self._lock:
+            if self._disk is not None:
+                self._disk.close()
+                self._disk = None
+
+    def _remember(self, key: str, vector: np.ndarray):
+        if key in self._vectors:
+            self._size_bytes -= self._vectors.pop(key).nbytes
+        self._vectors[key] = vector
+        self._size_bytes += vector.nbytes
+        while self._vectors and (len(self._vectors) > self.max_vectors or self._size_bytes > self.max_bytes):
+            _, evicted = self._vectors.popitem(last=False)
+            self._size_bytes -= evicted.nbytes
+
+
+embedding_cache = EmbeddingCache(
+    max_vectors=int(os.getenv("EMBEDDING_CACHE_MAX_VECTORS", 10000)),
+    max_bytes=int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+    disk_path=os.getenv("EMBEDDING_CACHE_DISK_PATH"),
+)
+# sentences of retrieved documents embedded for context compression, kept apart from the query vectors & memory only
+sentence_cache = EmbeddingCache(
+    max_vectors=int(os.getenv("SENTENCE_CACHE_MAX_VECTORS", 20000)),
+    max_bytes=int(os.getenv("SENTENCE_CACHE_MAX_BYTES", 64 * 1024 * 1024)),
+)
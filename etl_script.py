@@ -1,7 +1,15 @@
+import os
+import time
+import queue
 import logging
-from datetime import datetime
+import argparse
+import threading
+from itertools import islice
+from multiprocessing import get_context
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-from qdrant_manager import QdrantManager
+from qdrant_manager import QdrantManager, batched, EMBED_BATCH_SIZE, UPSERT_BATCH_SIZE, UPLOAD_WORKERS
+from resource_pool import resource_pool
 from markdown_docs_extractor import MarkdownDocsExtractor
 from pdf_parser_utils import name_divider_util
 
@@ -36,11 +44,19 @@ groups_mapper = {
         }
     }
 
-if __name__ == "__main__":
-    qdrant_manager = QdrantManager("medical_herbs_rag_instructor_embeddings")
-    qdrant_manager.create_vector_collection()
-    for doc_name, doc_instr in book_util_dict.items():
-        doc_start_timestamp = datetime.now()
+
+def extract_document(doc_name: str, doc_instr: tuple, chunks_queue, cancelled, batch_size: int) -> tuple[int, float]:
+    """
+    Extracts a chapter in an extraction worker process, sending its chunks to chunks_queue in batches as they're
+    split, followed by None. Stops early once the cancelled event is set by the embedding.
+
+    Returns:
+        tuple: Number of chunks & extraction seconds, without the time waiting for the embedding
+    """
+    start = time.perf_counter()
+    wait_seconds = 0.0
+    chunks_count = 0
+    try:
         md_docs_extractor = MarkdownDocsExtractor(
             input_file=doc_name,
             char_eraser=doc_instr[2]
@@ -50,10 +66,207 @@ if __name__ == "__main__":
         else:
             doc_name_compact = doc_name[:38]+doc_name[40:]
             doc_chunks = md_docs_extractor.extract_docs_by_categories(groups_mapper[doc_name_compact])
-        qdrant_manager.populate_vector_collection(
-            doc_name=doc_name,
-            doc_specifier=doc_instr[0],
-            doc_chunks=doc_chunks
+        for chunks_batch in batched(doc_chunks, batch_size):
+            if cancelled.is_set():
+                break
+            put_start = time.perf_counter()
+            chunks_queue.put(chunks_batch)
+            wait_seconds += time.perf_counter() - put_start
+            chunks_count += len(chunks_batch)
+    finally:
+        chunks_queue.put(None)
+    return chunks_count, time.perf_counter() - start - wait_seconds
+
+
+class QueuedChunks:
+    """
+    Chunks of a chapter an extraction worker sends to chunks_queue, iterating raises the error of the extraction.
+
+    close() must follow the embedding of the chapter: when it stopped before the end, the worker is cancelled
+    & the queue drained to its None, so the worker isn't left waiting on a full queue.
+    """
+
+    def __init__(self, chunks_queue, cancelled, extraction):
+        self.chunks_queue = chunks_queue
+        self.cancelled = cancelled
+        self.extraction = extraction
+        self.finished = False
+
+    def __iter__(self):
+        while (chunks_batch := self.chunks_queue.get()) is not None:
+            yield from chunks_batch
+        self.finished = True
+        self.extraction.result()
+
+    def close(self):
+        if self.finished:
+            return
+        self.cancelled.set()
+        while self.chunks_queue.get() is not None:
+            pass
+        self.finished = True
+
+
+class StageStats:
+    """Items processed & busy seconds of a pipeline stage, summed over its workers."""
+
+    def __init__(self, name: str, unit: str):
+        self.name = name
+        self.unit = unit
+        self.items = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items: int, seconds: float):
+        with self._lock:
+            self.items += items
+            self.seconds += seconds
+
+    def report(self) -> str:
+        throughput = self.items / self.seconds if self.seconds else 0.0
+        return f"{self.name}: {self.items} {self.unit} in {self.seconds:.2f}s busy, {throughput:.1f} {self.unit}/sec"
+
+
+def run_pipeline(qdrant_manager: QdrantManager, docs: dict, extract_workers: int, embed_workers: int,
+                 upload_workers: int, queue_size: int, embed_batch_size: int, upsert_batch_size: int) -> list:
+    """
+    Ingests chapters with extraction, embedding & upload running at the same time.
+
+    Markdown extraction runs in a process pool, embedding in embed_workers threads sharing the model and upserts
+    in an upload thread pool. Chunks are streamed from the extraction workers in batches of embed_batch_size, so
+    a chapter is never held whole in memory. Bounded queues between the stages make a stage wait when the next one
+    falls behind.
+
+    Returns:
+        list: Stats of every stage
+    """
+    extracted = queue.Queue(maxsize=queue_size)
+    embedded = queue.Queue(maxsize=queue_size)
+    extract_stats = StageStats("extract", "chunks")
+    embed_stats = StageStats("embed", "chunks")
+    upload_stats = StageStats("upload", "chunks")
+
+    def extract_stage(manager):
+        # spawned, not forked, workers: the parent process already runs threads & holds the embedding model
+        try:
+            with ProcessPoolExecutor(max_workers=extract_workers, mp_context=get_context("spawn")) as executor:
+                pending = {}
+                docs_iter = iter(docs.items())
+                while True:
+                    # only extract_workers chapters are extracted at a time, each one stops when queue_size batches
+                    # of its chunks wait for the embedding
+                    for doc_name, doc_instr in islice(docs_iter, extract_workers - len(pending)):
+                        chunks_queue = manager.Queue(maxsize=queue_size)
+                        cancelled = manager.Event()
+                        extraction = executor.submit(extract_document, doc_name, doc_instr, chunks_queue, cancelled,
+                                                     embed_batch_size)
+                        pending[extraction] = (doc_name, chunks_queue)
+                        extracted.put((doc_name, QueuedChunks(chunks_queue, cancelled, extraction)))
+                    if not pending:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for extraction in done:
+                        doc_name, chunks_queue = pending.pop(extraction)
+                        try:
+                            chunks_count, seconds = extraction.result()
+                        except Exception:
+                            # the worker may not have started, the embedding stops at None & logs the error
+                            chunks_queue.put(None)
+                            continue
+                        extract_stats.add(chunks_count, seconds)
+        finally:
+            for _ in range(embed_workers):
+                extracted.put(None)
+
+    def embed_stage(upload_executor):
+        try:
+            while (item := extracted.get()) is not None:
+                doc_name, doc_chunks = item
+                try:
+                    ingest = qdrant_manager.embed_document(
+                        doc_name=doc_name,
+                        doc_specifier=docs[doc_name][0],
+                        doc_chunks=doc_chunks,
+                        upload_executor=upload_executor,
+                        embed_batch_size=embed_batch_size,
+                        upsert_batch_size=upsert_batch_size,
+                        max_pending=2 * upload_workers
+                    )
+                except Exception as e:
+                    # a chapter failing in the middle isn't recorded, it's ingested again by the next run
+                    logging.exception(f"Extraction or embedding of {doc_name} failed: {e}")
+                    continue
+                finally:
+                    doc_chunks.close()
+                embed_stats.add(ingest.chunks_count, ingest.embed_seconds)
+                embedded.put(ingest)
+        finally:
+            embedded.put(None)
+
+    def finish_stage():
+        finished_embed_workers = 0
+        while finished_embed_workers < embed_workers:
+            ingest = embedded.get()
+            if ingest is None:
+                finished_embed_workers += 1
+                continue
+            try:
+                ingest_stats = qdrant_manager.finish_document(ingest)
+            except Exception as e:
+                logging.exception(f"Upload of {ingest.doc_name} failed: {e}")
+                continue
+            upload_stats.add(ingest_stats["chunks"] - ingest_stats["failed"], ingest_stats["upsert_seconds"])
+
+    # chunk queues of the extraction workers are served by a manager process
+    with get_context("spawn").Manager() as manager, ThreadPoolExecutor(max_workers=upload_workers) as upload_executor:
+        stage_threads = [threading.Thread(target=extract_stage, args=(manager,)),
+                         threading.Thread(target=finish_stage)]
+        stage_threads += [threading.Thread(target=embed_stage, args=(upload_executor,)) for _ in range(embed_workers)]
+        for thread in stage_threads:
+            thread.start()
+        for thread in stage_threads:
+            thread.join()
+    return [extract_stats, embed_stats, upload_stats]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extracts, embeds & uploads ebook chapters to a vector collection")
+    parser.add_argument("--collection", default="medical_herbs_rag_instructor_embeddings")
+    parser.add_argument("--docs", nargs="+", choices=list(book_util_dict), help="chapters to ingest (default: all)")
+    parser.add_argument("--extract-workers", type=int, default=min(len(book_util_dict), os.cpu_count() or 1),
+                        help="markdown extraction processes")
+    parser.add_argument("--embed-workers", type=int, default=1, help="threads embedding with the shared model")
+    parser.add_argument("--upload-workers", type=int, default=UPLOAD_WORKERS, help="upsert threads")
+    parser.add_argument("--queue-size", type=int, default=2,
+                        help="chapters waiting between two stages & chunk batches waiting per extracted chapter")
+    parser.add_argument("--embed-batch-size", type=int, default=EMBED_BATCH_SIZE)
+    parser.add_argument("--upsert-batch-size", type=int, default=UPSERT_BATCH_SIZE)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    start = time.perf_counter()
+    qdrant_manager = QdrantManager(args.collection)
+    qdrant_manager.create_vector_collection()
+    docs = {doc_name: book_util_dict[doc_name] for doc_name in args.docs} if args.docs else book_util_dict
+    try:
+        stage_stats = run_pipeline(
+            qdrant_manager,
+            docs,
+            extract_workers=args.extract_workers,
+            embed_workers=args.embed_workers,
+            upload_workers=args.upload_workers,
+            queue_size=args.queue_size,
+            embed_batch_size=args.embed_batch_size,
+            upsert_batch_size=args.upsert_batch_size
         )
-        logging.log(logging.INFO, f"{doc_name}: {(datetime.now() - doc_start_timestamp).seconds}")
-    qdrant_manager.close()
+    finally:
+        resource_pool.shutdown()
+    elapsed = time.perf_counter() - start
+    for stats in stage_stats:
+        logging.log(logging.INFO, stats.report())
+    logging.log(logging.INFO, f"{len(docs)} chapters in {elapsed:.2f}s total, "
+                              f"{stage_stats[1].items / elapsed if elapsed else 0.0:.1f} chunks/sec end to end")
+
+
+if __name__ == "__main__":
+    main()
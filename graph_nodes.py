@@ -1,8 +1,60 @@
+import os
+import time
+import logging
 from typing import List
+from langchain_core.runnables.config import ContextThreadPoolExecutor
 from typing_extensions import TypedDict
 from langchain_community.tools.tavily_search import TavilySearchResults
 from llm_chain_components import rag_chain, retrieval_grader, question_rewriter, answer_reviser
 from qdrant_manager import QdrantManager
+from relevance_filter import mmr_select
+from context_builder import build_context
+from tracing import traced_node, record_decision, record_context_tokens
+
+# max number of concurrent LLM grader calls in a single grade_documents pass
+GRADER_MAX_CONCURRENCY = int(os.getenv("GRADER_MAX_CONCURRENCY", 8))
+# concurrent web results revision calls of a single request, their time limit is REVISION_TIMEOUT of the reviser LLM
+REVISION_MAX_WORKERS = int(os.getenv("REVISION_MAX_WORKERS", 5))
+# keep revised web docs in the order they finish instead of the web search ranking
+REVISION_STREAM = os.getenv("REVISION_STREAM", "false").lower() == "true"
+
+# local pre-filter between retrieval & LLM grading: MMR over the retrieved vectors keeps at most
+# PREFILTER_TOP_N relevant documents & drops near-duplicates
+PREFILTER_ENABLED = os.getenv("PREFILTER_ENABLED", "true").lower() == "true"
+PREFILTER_TOP_N = int(os.getenv("PREFILTER_TOP_N", 5))
+PREFILTER_MMR_LAMBDA = float(os.getenv("PREFILTER_MMR_LAMBDA", 0.7))
+PREFILTER_DUPLICATE_THRESHOLD = float(os.getenv("PREFILTER_DUPLICATE_THRESHOLD", 0.97))
+
+# routing after grading: MIN_RELEVANT_DOCUMENTS relevant docs are enough to generate, fewer are enough when the best
+# of them is at least EARLY_ACCEPT_SCORE similar to the question. Query corrections stop after MAX_QUERY_CORRECTIONS,
+# when a rewrite raised the best retrieval score by less than REWRITE_MIN_GAIN or when less than
+# REWRITE_ROUND_SECONDS (rewrite, retrieval & grading) are left before the request deadline
+MIN_RELEVANT_DOCUMENTS = int(os.getenv("MIN_RELEVANT_DOCUMENTS", 3))
+EARLY_ACCEPT_SCORE = float(os.getenv("EARLY_ACCEPT_SCORE", 0.9))
+MAX_QUERY_CORRECTIONS = int(os.getenv("MAX_QUERY_CORRECTIONS", 2))
+REWRITE_MIN_GAIN = float(os.getenv("REWRITE_MIN_GAIN", 0.01))
+REWRITE_ROUND_SECONDS = float(os.getenv("REWRITE_ROUND_SECONDS", 4))
+
+# speculative query correction: the rewrite runs together with a deeper retrieval (SPECULATIVE_RETRIEVAL_LIMIT
+# documents) of the original question & optionally its web search, at most SPECULATIVE_MAX_CANDIDATES new
+# documents of both questions are graded. The web search is awaited for at most SPECULATIVE_WEB_TIMEOUT seconds
+# & only when the merged documents aren't enough. The background calls run in a pool of SPECULATIVE_MAX_WORKERS
+# threads (2 per request in flight)
+SPECULATIVE_RETRIEVAL = os.getenv("SPECULATIVE_RETRIEVAL", "false").lower() == "true"
+SPECULATIVE_WEB_SEARCH = os.getenv("SPECULATIVE_WEB_SEARCH", "true").lower() == "true"
+SPECULATIVE_RETRIEVAL_LIMIT = int(os.getenv("SPECULATIVE_RETRIEVAL_LIMIT", 16))
+SPECULATIVE_MAX_CANDIDATES = int(os.getenv("SPECULATIVE_MAX_CANDIDATES", 8))
+SPECULATIVE_WEB_TIMEOUT = float(os.getenv("SPECULATIVE_WEB_TIMEOUT", 10))
+SPECULATIVE_MAX_WORKERS = int(os.getenv("SPECULATIVE_MAX_WORKERS", 64))
+
+# generation context compression: repeated sentences dropped & when the documents are over the budget, the most
+# question relevant sentences packed into CONTEXT_TOKEN_BUDGET tokens, at most CONTEXT_DOC_TOKEN_LIMIT per document
+CONTEXT_COMPRESSION = os.getenv("CONTEXT_COMPRESSION", "true").lower() == "true"
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1500))
+CONTEXT_DOC_TOKEN_LIMIT = int(os.getenv("CONTEXT_DOC_TOKEN_LIMIT", 400))
+CONTEXT_DUPLICATE_THRESHOLD = float(os.getenv("CONTEXT_DUPLICATE_THRESHOLD", 0.95))
+
+speculation_executor = ContextThreadPoolExecutor(max_workers=SPECULATIVE_MAX_WORKERS)
 
 
 class GraphClass(TypedDict):
@@ -17,6 +69,12 @@ class GraphClass(TypedDict):
         query_correction_count: number of query transformation times
         last_iteration_state: state vars from nodes before overwriting with new values
         web_search_docs: results of a web search
+        document_vectors: embeddings of retrieved documents, used by the local pre-filter
+        retrieval_scores: similarity scores of retrieved documents to the question, of relevant ones after grading
+        best_scores: best retrieval score of every query correction iteration
+        deadline: time (epoch seconds) the answer should be ready by
+        retrieved_points: search results of the question prefetched by batch answering, used by the first retrieval
+        hybrid_search: dense + keyword (True) or dense only (False) retrieval, the collection's setting when missing
     """
 
     question: str
@@ -26,8 +84,15 @@ class GraphClass(TypedDict):
     query_correction_count: int
     last_iteration_state: dict
     web_search_docs: List[str]
+    document_vectors: List[List[float]]
+    retrieval_scores: List[float]
+    best_scores: List[float]
+    deadline: float
+    retrieved_points: list
+    hybrid_search: bool
 
 
+@traced_node
 def retrieve(state):
     """
     Retrieve documents from knowledge base.
@@ -43,13 +108,67 @@ def retrieve(state):
     collection_name = state["collection_name"]
 
     # Retrieval
-    qdrant_manager = QdrantManager(collection_name)
-    documents = qdrant_manager.make_query(question)
-    qdrant_manager.close()
+    points = state.get("retrieved_points")
+    if points is None:
+        points = QdrantManager(collection_name, hybrid=state.get("hybrid_search")).query_points(
+            question, with_vectors=PREFILTER_ENABLED
+        )
+    documents = [point.payload for point in points]
+    document_vectors = [point.vector for point in points] if PREFILTER_ENABLED else []
+    retrieval_scores = [point.score for point in points]
+
+    return {
+        "documents": documents,
+        "document_vectors": document_vectors,
+        "retrieval_scores": retrieval_scores,
+        "best_scores": (state.get("best_scores") or []) + [max(retrieval_scores, default=0.0)],
+        "retrieved_points": None,
+        "question": question
+    }
+
+
+def prefetch_retrieval(collection_name: str, questions: List[str], query_vectors: list) -> list:
+    """First retrieval of many questions in a single batch search, passed to the graph as retrieved_points."""
+    return QdrantManager(collection_name).query_points_batch(questions, query_vectors, with_vectors=PREFILTER_ENABLED)
+
 
-    return {"documents": documents, "question": question}
+@traced_node
+def prefilter_documents(state):
+    """
+    Selects the most relevant, non-duplicated documents locally before sending them to the LLM grader.
 
+    Args:
+        state (dict): The current graph state
 
+    Returns:
+        state (dict): Updates documents key with selected documents in relevance order
+    """
+    print("---PREFILTER DOCUMENTS---")
+    question = state["question"]
+    documents = state["documents"]
+    document_vectors = state.get("document_vectors") or []
+    retrieval_scores = state.get("retrieval_scores") or []
+
+    if len(document_vectors) != len(documents) or any(vector is None for vector in document_vectors):
+        return {"document_vectors": []}
+    query_vector = QdrantManager(state["collection_name"]).embed_query(question)
+    selected = mmr_select(
+        query_vector,
+        document_vectors,
+        top_n=PREFILTER_TOP_N,
+        lambda_mult=PREFILTER_MMR_LAMBDA,
+        duplicate_threshold=PREFILTER_DUPLICATE_THRESHOLD
+    )
+    print(f"---PREFILTER: {len(selected)}/{len(documents)} DOCUMENTS KEPT---")
+
+    return {
+        "documents": [documents[i] for i in selected],
+        "retrieval_scores": [retrieval_scores[i] for i in selected] if retrieval_scores else [],
+        "document_vectors": []
+    }
+
+
+@traced_node
 def generate(state):
     """
     Generate answer
@@ -64,11 +183,27 @@ def generate(state):
     question = state["question"]
     documents = state["documents"]
 
-    # RAG generation
-    generation = rag_chain.invoke({"context": documents, "question": question})
+    # only the prompt gets the compressed context, the answer keeps whole documents
+    context = documents
+    if CONTEXT_COMPRESSION and documents:
+        qdrant_manager = QdrantManager(state["collection_name"], hybrid=state.get("hybrid_search"))
+        context, tokens_before, tokens_after = build_context(
+            qdrant_manager.embed_query(question),
+            documents,
+            qdrant_manager.embed_sentences,
+            token_budget=CONTEXT_TOKEN_BUDGET,
+            doc_token_limit=CONTEXT_DOC_TOKEN_LIMIT,
+            duplicate_threshold=CONTEXT_DUPLICATE_THRESHOLD
+        )
+        record_context_tokens(tokens_before, tokens_after)
+        print(f"---CONTEXT: {tokens_after}/{tokens_before} TOKENS---")
+
+    # RAG generation, streamed so the tokens reach streaming endpoints as they're produced
+    generation = "".join(rag_chain.stream({"context": context, "question": question}))
     return {"documents": documents, "question": question, "generation": generation}
 
 
+@traced_node
 def grade_documents(state):
     """
     Determines whether the retrieved documents are relevant to the question.
@@ -83,28 +218,63 @@ def grade_documents(state):
     print("---CHECK DOCUMENT RELEVANCE TO QUESTION---")
     question = state["question"]
     documents = state["documents"]
+    retrieval_scores = state.get("retrieval_scores") or []
     last_iteration_state = state["last_iteration_state"]
 
-    # Score each doc
-    filtered_docs = []
-    for doc in documents:
-        score = retrieval_grader.invoke(
-            {"question": question, "document": doc}
-        )
-        if score.binary_score == "yes":
-            print("---GRADE: DOCUMENT RELEVANT---")
-            filtered_docs.append({"content": doc["content"], "source": doc["ebook_chapter"]})
+    filtered_docs, filtered_scores = grade_relevant_documents(question, documents, retrieval_scores)
+    last_iteration_state["graded_contents"] = (last_iteration_state.get("graded_contents", [])
+                                               + [doc["content"] for doc in documents])
 
     if len(filtered_docs) < len(last_iteration_state.get("documents", [])):
-        question = last_iteration_state["question"]
-        documents = last_iteration_state["documents"]
-        return {"documents": documents, "question": question}
+        # the rewritten question found fewer relevant documents than the previous one
+        logging.info(f"Question '{question}' has {len(filtered_docs)} relevant documents, "
+                     f"keeping {len(last_iteration_state['documents'])} of '{last_iteration_state['question']}'")
+        return {
+            "documents": last_iteration_state["documents"],
+            "question": last_iteration_state["question"],
+            "retrieval_scores": last_iteration_state.get("retrieval_scores", []),
+            "last_iteration_state": last_iteration_state
+        }
 
     last_iteration_state["documents"] = filtered_docs
     last_iteration_state["question"] = question
-    return {"documents": filtered_docs, "last_iteration_state": last_iteration_state}
+    last_iteration_state["retrieval_scores"] = filtered_scores
+    return {"documents": filtered_docs, "retrieval_scores": filtered_scores, "last_iteration_state": last_iteration_state}
 
 
+def grade_relevant_documents(question: str, documents: List[dict], retrieval_scores: List[float]):
+    """
+    Grades retrieved documents with the LLM grader.
+
+    Args:
+        question (str): The question to grade documents against
+        documents (List[dict]): Retrieved documents payloads
+        retrieval_scores (List[float]): Similarity scores of the documents, may be empty
+
+    Returns:
+        tuple: Relevant documents with content & source and their similarity scores
+    """
+    # Score all docs concurrently, batch keeps the order of documents
+    scores = retrieval_grader.batch(
+        [{"question": question, "document": doc} for doc in documents],
+        config={"max_concurrency": GRADER_MAX_CONCURRENCY},
+        return_exceptions=True
+    )
+    filtered_docs = []
+    filtered_scores = []
+    for i, (doc, score) in enumerate(zip(documents, scores)):
+        if isinstance(score, Exception):
+            # a failed grading call counts as irrelevant document instead of failing the whole node
+            logging.warning(f"Grading of a document from {doc.get('ebook_chapter')} failed: {score}")
+            continue
+        if score.binary_score == "yes":
+            print("---GRADE: DOCUMENT RELEVANT---")
+            filtered_docs.append({"content": doc["content"], "source": doc["ebook_chapter"]})
+            filtered_scores.append(retrieval_scores[i] if i < len(retrieval_scores) else 0.0)
+    return filtered_docs, filtered_scores
+
+
+@traced_node
 def transform_query(state):
     """
     Transform the query to produce a better question.
@@ -127,6 +297,7 @@ def transform_query(state):
     return {"question": new_question, "query_correction_count": query_correction_count}
 
 
+@traced_node
 def web_search(state):
     """
     Web search based on the re-phrased question.
@@ -141,13 +312,101 @@ def web_search(state):
     print("---WEB SEARCH---")
     question = state["question"]
 
-    # Web search
-    docs = TavilySearchResults().invoke({"query": question})
-    web_results = [{"content": doc["content"], "source": doc["url"]} for doc in docs]
+    web_results = search_web(question)
 
     return {"web_search_docs": web_results, "question": question}
 
 
+def search_web(question: str) -> List[dict]:
+    docs = TavilySearchResults().invoke({"query": question})
+    return [{"content": doc["content"], "source": doc["url"]} for doc in docs]
+
+
+@traced_node
+def speculative_retrieve(state):
+    """
+    Query correction with the rewrite, retrieval & web search running concurrently instead of one after another.
+
+    While the question is rewritten, more documents are retrieved for the original question & the web is searched
+    for it (if SPECULATIVE_WEB_SEARCH). Documents of both questions not graded before are graded in one batch and
+    the relevant ones are added to the documents found so far.
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        state (dict): Updates question with the re-phrased one, documents with merged relevant documents and
+            web_search_docs with web results
+    """
+
+    print("---SPECULATIVE RETRIEVE---")
+    question = state["question"]
+    documents = state["documents"]
+    retrieval_scores = state.get("retrieval_scores") or []
+    last_iteration_state = state["last_iteration_state"]
+    qdrant_manager = QdrantManager(state["collection_name"], hybrid=state.get("hybrid_search"))
+
+    web_future = speculation_executor.submit(search_web, question) if SPECULATIVE_WEB_SEARCH else None
+    deeper_future = speculation_executor.submit(qdrant_manager.query_points, question, limit=SPECULATIVE_RETRIEVAL_LIMIT)
+    new_question = question_rewriter.invoke({"question": question})
+    print("---IMPROVED QUESTION---")
+    print(new_question)
+    rewritten_points = qdrant_manager.query_points(new_question)
+    try:
+        deeper_points = deeper_future.result()
+    except Exception as e:
+        logging.warning(f"Deeper retrieval of '{question}' failed: {e}")
+        deeper_points = []
+
+    # documents of the rewritten question first, then the ones past the first retrieval of the original one
+    seen_contents = set(last_iteration_state.get("graded_contents", [])) | {doc["content"] for doc in documents}
+    candidates = []
+    for point in rewritten_points + deeper_points:
+        if point.payload["content"] not in seen_contents:
+            seen_contents.add(point.payload["content"])
+            candidates.append(point)
+    candidates = candidates[:SPECULATIVE_MAX_CANDIDATES]
+    new_docs, new_scores = grade_relevant_documents(
+        new_question, [point.payload for point in candidates], [point.score for point in candidates]
+    )
+    print(f"---SPECULATIVE RETRIEVE: {len(new_docs)}/{len(candidates)} NEW DOCUMENTS RELEVANT---")
+
+    merged_docs = documents + new_docs
+    merged_scores = (retrieval_scores if len(retrieval_scores) == len(documents) else [0.0] * len(documents)) + new_scores
+    best_scores = (state.get("best_scores") or []) + [max((point.score for point in rewritten_points), default=0.0)]
+
+    web_results = None
+    if web_future is not None:
+        decision, _ = route_after_grading({**state, "documents": merged_docs, "retrieval_scores": merged_scores,
+                                           "best_scores": best_scores,
+                                           "query_correction_count": state["query_correction_count"] + 1})
+        if decision == "web_search":
+            try:
+                web_results = web_future.result(timeout=SPECULATIVE_WEB_TIMEOUT)
+            except Exception as e:
+                # revision goes on with no web results rather than searching again
+                logging.warning(f"Web search of '{question}' failed: {e!r}")
+                web_results = []
+        else:
+            # not needed, the search is dropped if it hasn't started yet
+            web_future.cancel()
+    last_iteration_state["documents"] = merged_docs
+    last_iteration_state["question"] = new_question
+    last_iteration_state["retrieval_scores"] = merged_scores
+    last_iteration_state["graded_contents"] = (last_iteration_state.get("graded_contents", [])
+                                               + [point.payload["content"] for point in candidates])
+    return {
+        "question": new_question,
+        "query_correction_count": state["query_correction_count"] + 1,
+        "documents": merged_docs,
+        "retrieval_scores": merged_scores,
+        "best_scores": best_scores,
+        "web_search_docs": web_results,
+        "last_iteration_state": last_iteration_state
+    }
+
+
+@traced_node
 def revision(state):
     """
     Revision of an answer of conducted web search.
@@ -161,25 +420,58 @@ def revision(state):
 
     print("---ANSWER REVISION---")
     question = state["question"]
-    documents = state["documents"]
+    documents = list(state["documents"])
     web_results = state["web_search_docs"]
 
-    for web_doc in web_results:
-        filtered_content = answer_reviser.invoke({"question": question, "answer": web_doc["content"]})
-        documents.append({"content": filtered_content, "source": web_doc["source"]})
-        print("---FILTERED WEB CONTENT---")
-        print(filtered_content)
+    revised_docs = list(iter_revised_web_docs(question, web_results))
+    if not REVISION_STREAM:
+        # back to the web search ranking order
+        sources_rank = {web_doc["source"]: rank for rank, web_doc in enumerate(web_results)}
+        revised_docs.sort(key=lambda doc: sources_rank[doc["source"]])
+    documents.extend(revised_docs)
+    print(f"---FILTERED WEB CONTENT: {len(revised_docs)}/{len(web_results)} RESULTS---")
 
     return {"documents": documents}
 
 
+def iter_revised_web_docs(question: str, web_results: List[dict]):
+    """
+    Revises web results concurrently and yields them as soon as each one is finished.
+
+    Args:
+        question (str): The question to filter web content by
+        web_results (List[dict]): Web search results with content & source
+
+    Yields:
+        dict: Revised web document, results failing or exceeding the reviser's timeout are dropped
+    """
+    # every request revises in its own bounded pool, so it never waits behind revisions of other requests
+    revisions = answer_reviser.batch_as_completed(
+        [{"question": question, "answer": web_doc["content"]} for web_doc in web_results],
+        config={"max_concurrency": REVISION_MAX_WORKERS},
+        return_exceptions=True
+    )
+    for i, filtered_content in revisions:
+        web_doc = web_results[i]
+        if isinstance(filtered_content, Exception):
+            # includes calls over the reviser's request timeout
+            logging.warning(f"Revision of {web_doc['source']} failed: {filtered_content!r}")
+            continue
+        logging.debug(f"Filtered web content of {web_doc['source']}: {filtered_content}")
+        yield {"content": filtered_content, "source": web_doc["source"]}
+
+
 # Edges
-def decide_to_generate(state):
+def decide_to_generate(state, config=None):
     """
     Determines whether to generate an answer, or re-generate a question.
 
+    Generates as soon as the relevant documents are enough or similar enough to the question and skips further
+    query corrections, when they can't improve retrieval or don't fit in the request deadline.
+
     Args:
         state (dict): The current graph state
+        config (dict): Graph run config, the decision is added to its request trace
 
     Returns:
         str: Binary decision for next node to call
@@ -189,16 +481,70 @@ def decide_to_generate(state):
 
     relevant_documents = len(state["documents"])
     query_correction_count = state["query_correction_count"]
+    best_relevant_score = max(state.get("retrieval_scores") or [], default=0.0)
+    deadline = state.get("deadline")
+    seconds_left = deadline - time.time() if deadline else None
     print(f"---RELEVANT DOCUMENTS: {relevant_documents}---")
-    if relevant_documents > 2 >= query_correction_count:
-        # We have relevant documents, so generate answer
-        print("---DECISION: GENERATE---")
-        return "generate"
-    elif query_correction_count == 2:
-        # Too many attempts to transform query, so do a websearch
-        print("---DECISION: WEB SEARCH---")
-        return "web_search"
-    else:
-        # There are not enough documents after filtering, so regenerate a new query
-        print("---DECISION: NOT ENOUGH DOCUMENTS ARE RELEVANT TO QUESTION, TRANSFORM QUERY---")
-        return "transform_query"
+    decision, reason = route_after_grading(state)
+
+    print(f"---DECISION: {decision.upper()} ({reason})---")
+    logging.info(f"Iteration {query_correction_count}: {decision} ({reason}), {relevant_documents} relevant documents, "
+                 f"best score {best_relevant_score:.3f}")
+    record_decision(
+        config, decision, reason,
+        iteration=query_correction_count,
+        relevant_documents=relevant_documents,
+        best_relevant_score=round(best_relevant_score, 4),
+        seconds_left=round(seconds_left, 3) if seconds_left is not None else None
+    )
+    return decision
+
+
+def route_after_grading(state) -> tuple[str, str]:
+    """
+    Picks the next node after grading without side effects.
+
+    Args:
+        state (dict): The current graph state
+
+    Returns:
+        tuple: Next node & the reason of the decision
+    """
+    relevant_documents = len(state["documents"])
+    best_relevant_score = max(state.get("retrieval_scores") or [], default=0.0)
+    best_scores = state.get("best_scores") or []
+    deadline = state.get("deadline")
+    seconds_left = deadline - time.time() if deadline else None
+
+    if relevant_documents >= MIN_RELEVANT_DOCUMENTS:
+        return "generate", "enough_relevant"
+    if relevant_documents and best_relevant_score >= EARLY_ACCEPT_SCORE:
+        return "generate", "high_score"
+    if state["query_correction_count"] >= MAX_QUERY_CORRECTIONS:
+        return "web_search", "max_corrections"
+    if seconds_left is not None and seconds_left < REWRITE_ROUND_SECONDS:
+        # no time for another round, relevant documents found so far are answered right away
+        return ("generate" if relevant_documents else "web_search"), "deadline"
+    if len(best_scores) > 1 and best_scores[-1] - best_scores[-2] < REWRITE_MIN_GAIN:
+        # the last rewrite didn't bring the question closer to the collection, another one won't either
+        return "web_search", "no_rewrite_gain"
+    return ("speculative_retrieve" if SPECULATIVE_RETRIEVAL else "transform_query"), "not_enough_relevant"
+
+
+def decide_after_speculation(state, config=None):
+    """
+    Routes after speculative retrieval: web results already fetched are revised instead of searching the web again.
+
+    Args:
+        state (dict): The current graph state
+        config (dict): Graph run config, the decision is added to its request trace
+
+    Returns:
+        str: Next node to call
+    """
+    decision = decide_to_generate(state, config)
+    if decision == "web_search" and state.get("web_search_docs") is not None:
+        print("---DECISION: REVISION (speculative_web_results)---")
+        record_decision(config, "revision", "speculative_web_results", iteration=state["query_correction_count"])
+        return "revision"
+    return decision
@@ -1,30 +1,47 @@
 from langgraph.graph import START, END, StateGraph
-from graph_nodes import GraphClass, retrieve, grade_documents, generate, transform_query, web_search, revision, \
-    decide_to_generate
+from graph_nodes import GraphClass, retrieve, prefilter_documents, grade_documents, generate, transform_query, \
+    web_search, revision, speculative_retrieve, decide_to_generate, decide_after_speculation
 
 workflow = StateGraph(GraphClass)
 
 # Define the nodes
 workflow.add_node("retrieve", retrieve)
+workflow.add_node("prefilter_documents", prefilter_documents)
 workflow.add_node("grade_documents", grade_documents)
 workflow.add_node("generate", generate)
 workflow.add_node("transform_query", transform_query)
 workflow.add_node("web_search", web_search)
 workflow.add_node("revision", revision)
+workflow.add_node("speculative_retrieve", speculative_retrieve)
 
 # Build graph
 workflow.add_edge(START, "retrieve")
-workflow.add_edge("retrieve", "grade_documents")
+workflow.add_edge("retrieve", "prefilter_documents")
+workflow.add_edge("prefilter_documents", "grade_documents")
 workflow.add_conditional_edges(
     "grade_documents",
     decide_to_generate,
     {
         "transform_query": "transform_query",
         "generate": "generate",
-        "web_search": "web_search"
+        "web_search": "web_search",
+        "speculative_retrieve": "speculative_retrieve"
+    },
+)
+workflow.add_conditional_edges(
+    "speculative_retrieve",
+    decide_after_speculation,
+    {
+        "generate": "generate",
+        "web_search": "web_search",
+        "revision": "revision",
+        "speculative_retrieve": "speculative_retrieve"
     },
 )
 workflow.add_edge("transform_query", "retrieve")
 workflow.add_edge("web_search", "revision")
 workflow.add_edge("revision", "generate")
 workflow.add_edge("generate", END)
+
+# Compiled once per process & shared by all requests
+agent = workflow.compile()
@@ -0,0 +1,50 @@
+import os
+import json
+import uuid
+import hashlib
+
+from atomic_io import write_json_atomically
+
+INGEST_MANIFEST_DIR = os.getenv("INGEST_MANIFEST_DIR", "./data_store/manifests")
+# namespace of deterministic point IDs, changing it re-creates all of them
+POINT_ID_NAMESPACE = uuid.UUID("6f1c3f4e-2b7a-4d8e-9a51-0c7d3e2b9f10")
+
+
+def chunk_content_hash(doc_instruction: str, content: str, metadata: dict) -> str:
+    # instruction is a part of the hash, since a different one produces a different embedding
+    hashed = json.dumps([doc_instruction, content, metadata], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(hashed.encode("utf-8")).hexdigest()
+
+
+def chunk_point_id(doc_name: str, content_hash: str) -> str:
+    return uuid.uuid5(POINT_ID_NAMESPACE, f"{doc_name}/{content_hash}").hex
+
+
+class IngestManifest:
+    """
+    Point IDs & content hashes of chunks ingested into a collection, grouped by ebook chapter.
+
+    Lets the ETL re-run embed & upsert only new or changed chunks and delete the ones gone from the source files.
+    """
+
+    def __init__(self, collection_name: str):
+        self.path = os.path.join(INGEST_MANIFEST_DIR, f"{collection_name}.json")
+        try:
+            with open(self.path, 'r', encoding="utf-8") as f:
+                self._docs = json.load(f)
+        except FileNotFoundError:
+            self._docs = {}
+
+    def get(self, doc_name: str) -> dict[str, str]:
+        return dict(self._docs.get(doc_name, {}))
+
+    def update(self, doc_name: str, point_hashes: dict[str, str]):
+        self._docs[doc_name] = point_hashes
+
+    def clear(self):
+        self._docs = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def save(self):
+        write_json_atomically(self.path, self._docs)
@@ -3,6 +3,7 @@ from langchain_groq import ChatGroq
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.pydantic_v1 import BaseModel, Field
 from langchain_core.output_parsers import StrOutputParser
+from tracing import llm_usage_callback
 
 # RAG chain
 rag_prompt = ChatPromptTemplate.from_messages(
@@ -22,10 +23,14 @@ llm_rag = ChatGroq(
     model="llama3-8b-8192",
     temperature=0.0,
     max_retries=2,
-    api_key=os.environ.get("GROQ_KEY")
+    api_key=os.environ.get("GROQ_KEY"),
+    callbacks=[llm_usage_callback]
 )
 
-rag_chain = rag_prompt | llm_rag | StrOutputParser()
+# tag of the generation runs, lets streaming endpoints pick the answer tokens out of all graph events
+RAG_GENERATION_TAG = "rag_generation"
+
+rag_chain = (rag_prompt | llm_rag | StrOutputParser()).with_config(tags=[RAG_GENERATION_TAG])
 
 
 # Grader chain
@@ -41,7 +46,8 @@ llm_grader = ChatGroq(
     model="llama3-8b-8192",
     temperature=0.0,
     max_retries=2,
-    api_key=os.environ.get("GROQ_KEY")
+    api_key=os.environ.get("GROQ_KEY"),
+    callbacks=[llm_usage_callback]
 ).with_structured_output(DocsGrader)
 
 grade_prompt = ChatPromptTemplate.from_messages(
@@ -60,7 +66,8 @@ llm_rewriter = ChatGroq(
     model="llama3-8b-8192",
     temperature=0.3,
     max_retries=2,
-    api_key=os.environ.get("GROQ_KEY")
+    api_key=os.environ.get("GROQ_KEY"),
+    callbacks=[llm_usage_callback]
 )
 
 rewrite_prompt = ChatPromptTemplate.from_messages(
@@ -77,12 +84,16 @@ rewrite_prompt = ChatPromptTemplate.from_messages(
 
 question_rewriter = rewrite_prompt | llm_rewriter | StrOutputParser()
 
-# Web search revision chain
+# Web search revision chain, every request to Groq gets REVISION_TIMEOUT seconds from the moment it's sent
+REVISION_TIMEOUT = float(os.getenv("REVISION_TIMEOUT", 15))
+
 llm_reviser = ChatGroq(
     model="llama3-8b-8192",
     temperature=0.0,
     max_retries=2,
-    api_key=os.environ.get("GROQ_KEY")
+    timeout=REVISION_TIMEOUT,
+    api_key=os.environ.get("GROQ_KEY"),
+    callbacks=[llm_usage_callback]
 )
 
 revision_prompt = ChatPromptTemplate.from_messages(
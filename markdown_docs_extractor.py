@@ -1,37 +1,121 @@
 import re
+from typing import Iterator
 
 from langchain_core.documents import Document as Langchain_Doc
-from langchain_community.document_loaders import TextLoader
-from langchain_text_splitters import MarkdownHeaderTextSplitter
+
+COMMON_NAME_PATTERN = re.compile(r'(?<=\*)(.*?)(?=\*)')
 
 
 class MarkdownDocsExtractor:
+    """
+    Splits a chapter markdown file into chunks by its headers.
+
+    The file is read line by line and chunks are yielded as soon as they're complete, so memory use
+    depends on the largest subject, not on the chapter size.
+    """
+
     def __init__(self, input_file: str, char_eraser: str = None):
-        self.loader = TextLoader(f'./data_store/{input_file}.md', encoding="utf-8")
-        self.md_splitter = MarkdownHeaderTextSplitter(
-            headers_to_split_on=[
-                ("#", "subject"),
-                ("##", "section"),
-                ("###", "paragraph"),
-            ],
-            strip_headers=True
-        )
+        self.file_path = f'./data_store/{input_file}.md'
+        # longest separators first, so "##" isn't taken for "#"
+        self.headers_to_split_on = [
+            ("###", "paragraph"),
+            ("##", "section"),
+            ("#", "subject"),
+        ]
         self.char_eraser = char_eraser
 
-    def extract_docs_by_categories(self, categories_groups: dict[str, set]):
-        documents = self.loader.load()
-        doc_chunks_list = [self.md_splitter.split_text(doc.page_content) for doc in documents]
-        doc_chunks = [single_chunk for chunks in doc_chunks_list for single_chunk in chunks]
-        first_group_name = list(categories_groups.keys())[0]
-        name_store = ""
-        new_doc_contents = {}
-        new_chunks = []
-        for doc in doc_chunks:
+    def iter_chunks(self) -> Iterator[Langchain_Doc]:
+        """
+        Yields the same chunks as MarkdownHeaderTextSplitter(strip_headers=True) splitting the whole file.
+
+        Lines are stripped, blank lines end a block, header lines start a new one. Consecutive blocks with
+        the same headers metadata make up a single chunk.
+        """
+        chunk_lines = []
+        chunk_metadata = None
+        current_content = []
+        current_metadata = {}
+        header_stack = []
+        initial_metadata = {}
+        in_code_block = False
+        opening_fence = ""
+
+        def end_block(metadata: dict):
+            # returns the finished chunk, when the block doesn't continue it
+            nonlocal chunk_lines, chunk_metadata
+            content = "\n".join(current_content)
+            current_content.clear()
+            if chunk_lines and chunk_metadata == metadata:
+                chunk_lines.append(content)
+                return None
+            finished_chunk = self._make_chunk(chunk_lines, chunk_metadata)
+            chunk_lines = [content]
+            chunk_metadata = metadata.copy()
+            return finished_chunk
+
+        with open(self.file_path, 'r', encoding="utf-8") as f:
+            for line in f:
+                stripped_line = line.strip()
+                if not stripped_line.isprintable():
+                    stripped_line = "".join(filter(str.isprintable, stripped_line))
+                if not in_code_block:
+                    if stripped_line.startswith("```") and stripped_line.count("```") == 1:
+                        in_code_block = True
+                        opening_fence = "```"
+                    elif stripped_line.startswith("~~~"):
+                        in_code_block = True
+                        opening_fence = "~~~"
+                elif stripped_line.startswith(opening_fence):
+                    in_code_block = False
+                    opening_fence = ""
+
+                if in_code_block:
+                    current_content.append(stripped_line)
+                    continue
+
+                finished_chunk = None
+                for sep, name in self.headers_to_split_on:
+                    if stripped_line.startswith(sep) and (
+                            len(stripped_line) == len(sep) or stripped_line[len(sep)] == " "):
+                        header_level = len(sep)
+                        while header_stack and header_stack[-1][0] >= header_level:
+                            initial_metadata.pop(header_stack.pop()[1], None)
+                        header_stack.append((header_level, name))
+                        initial_metadata[name] = stripped_line[len(sep):].strip()
+                        if current_content:
+                            finished_chunk = end_block(current_metadata)
+                        break
+                else:
+                    if stripped_line:
+                        current_content.append(stripped_line)
+                    elif current_content:
+                        finished_chunk = end_block(current_metadata)
+                if finished_chunk is not None:
+                    yield finished_chunk
+                current_metadata = initial_metadata.copy()
+
+        if current_content:
+            finished_chunk = end_block(current_metadata)
+            if finished_chunk is not None:
+                yield finished_chunk
+        if chunk_lines:
+            yield self._make_chunk(chunk_lines, chunk_metadata)
+
+    def extract_docs_by_categories(self, categories_groups: dict[str, set]) -> Iterator[Langchain_Doc]:
+        """
+        Yields a chunk per subject & categories group, made of the subject's sections belonging to the group.
+
+        The first chunk of a subject always goes to the first group.
+        """
+        first_group_name = next(iter(categories_groups))
+        name_store = None
+        group_contents = {}
+        for doc in self.iter_chunks():
             current_subject = doc.metadata.get("subject")
             section = doc.metadata.get("section")
             paragraph = doc.metadata.get("paragraph")
             doc_content = doc.page_content.replace(self.char_eraser, " ") if self.char_eraser else doc.page_content
-            common_name = re.search(r'(?<=\*)(.*?)(?=\*)', current_subject).group(0)
+            common_name = COMMON_NAME_PATTERN.search(current_subject).group(0)
             if paragraph:
                 middle_text = " - " + paragraph
             else:
@@ -40,23 +124,16 @@ class MarkdownDocsExtractor:
             if name_store == current_subject:
                 for group_name, old_categories in categories_groups.items():
                     if section in old_categories:
-                        new_doc_contents[group_name] += doc_title
-                        new_doc_contents[group_name] += doc_content + "\n"
+                        group_contents[group_name].extend((doc_title, doc_content, "\n"))
             else:
-                for new_category, content in new_doc_contents.items():
-                    new_chunks.append(Langchain_Doc(page_content=content, metadata={"subject": name_store, "section": new_category}))
+                yield from self._group_chunks(name_store, group_contents)
                 name_store = current_subject
-                new_doc_contents.update({group_name: "" for group_name in categories_groups.keys()})
-                new_doc_contents[first_group_name] += doc_title
-                new_doc_contents[first_group_name] += doc_content + "\n"
-        return new_chunks
-
-    def extract_docs(self):
-        documents = self.loader.load()
-        doc_chunks_list = [self.md_splitter.split_text(doc.page_content) for doc in documents]
-        doc_chunks = doc_chunks_list[0]
-        titled_chunks = []
-        for chunk in doc_chunks:
+                group_contents = {group_name: [] for group_name in categories_groups}
+                group_contents[first_group_name].extend((doc_title, doc_content, "\n"))
+        yield from self._group_chunks(name_store, group_contents)
+
+    def extract_docs(self) -> Iterator[Langchain_Doc]:
+        for chunk in self.iter_chunks():
             subject = chunk.metadata.get("subject")
             section = chunk.metadata.get("section")
             paragraph = chunk.metadata.get("paragraph")
@@ -64,6 +141,15 @@ class MarkdownDocsExtractor:
                 middle_text = " - " + paragraph
             else:
                 middle_text = "; " + section if section else ""
-            titled_chunks.append(
-                Langchain_Doc(page_content=subject + middle_text + ":\n" + chunk.page_content, metadata=chunk.metadata))
-        return titled_chunks
+            yield Langchain_Doc(page_content=subject + middle_text + ":\n" + chunk.page_content, metadata=chunk.metadata)
+
+    @staticmethod
+    def _make_chunk(chunk_lines: list[str], chunk_metadata: dict):
+        if not chunk_lines:
+            return None
+        return Langchain_Doc(page_content="  \n".join(chunk_lines), metadata=chunk_metadata)
+
+    @staticmethod
+    def _group_chunks(subject: str, group_contents: dict[str, list[str]]) -> Iterator[Langchain_Doc]:
+        for group_name, content_parts in group_contents.items():
+            yield Langchain_Doc(page_content="".join(content_parts), metadata={"subject": subject, "section": group_name})
@@ -0,0 +1,94 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+from atomic_io import write_text_atomically, write_json_atomically
+
+PARSE_CACHE_DIR = os.getenv("PARSE_CACHE_DIR", "./data_store/parse_cache")
+
+
+def file_sha256(file_path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while block := f.read(1024 * 1024):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+class ParseCache:
+    """
+    Parsed text of PDFs, content-addressed by the PDF hash, parser & every parser option changing its output.
+
+    A changed PDF, parsing instruction or column layout gets a new key, so it's parsed again, while repeated
+    ETL runs reuse the stored text. The index file also records which parse every exported file was written
+    from, so exports are rewritten only when their parse changes.
+    """
+
+    def __init__(self, cache_dir: str = PARSE_CACHE_DIR):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, "index.json")
+        self._lock = threading.Lock()
+        try:
+            with open(self.index_path, 'r', encoding="utf-8") as f:
+                self._index = json.load(f)
+        except FileNotFoundError:
+            self._index = {"parses": {}, "outputs": {}}
+
+    @staticmethod
+    def parse_key(pdf_source_path: str, parser_name: str, parser_options: dict) -> str:
+        hashed = json.dumps([file_sha256(pdf_source_path), parser_name, parser_options], sort_keys=True,
+                            ensure_ascii=False)
+        return hashlib.sha256(hashed.encode("utf-8")).hexdigest()
+
+    def get_or_parse(self, key: str, parse, source: dict) -> str:
+        """
+        Returns the cached text of a parse key or runs parse() and stores its result.
+
+        Args:
+            key (str): Key from parse_key()
+            parse: Function returning the parsed text
+            source (dict): PDF path, parser & options, recorded in the index
+        """
+        text_path = os.path.join(self.cache_dir, f"{key}.txt")
+        if key in self._index["parses"] and os.path.exists(text_path):
+            with open(text_path, 'r', encoding="utf-8") as f:
+                return f.read()
+
+        logging.log(logging.INFO, f"Parsing {source.get('source')} with {source.get('parser')}")
+        text = parse()
+        write_text_atomically(text_path, text)
+        with self._lock:
+            self._index["parses"][key] = {**source, "created_at": time.time()}
+            self._save()
+        return text
+
+    def export(self, output_file_path: str, key: str, text: str):
+        """Writes text of a parse to output_file_path, unless the file was already written from the same parse."""
+        if not self.is_output_current(output_file_path, key):
+            write_text_atomically(output_file_path, text)
+            self.record_output(output_file_path, key)
+
+    def is_output_current(self, output_file_path: str, key: str) -> bool:
+        recorded_key = self._index["outputs"].get(output_file_path)
+        if not os.path.exists(output_file_path):
+            return False
+        if recorded_key is None:
+            # written before the cache existed (and possibly corrected by hand), adopted as it is
+            logging.warning(f"{output_file_path} has no recorded parse, kept as the output of the current one")
+            self.record_output(output_file_path, key)
+            return True
+        return recorded_key == key
+
+    def record_output(self, output_file_path: str, key: str):
+        with self._lock:
+            self._index["outputs"][output_file_path] = key
+            self._save()
+
+    def _save(self):
+        write_json_atomically(self.index_path, self._index, ensure_ascii=False, indent=1)
+
+
+parse_cache = ParseCache()
@@ -1,8 +1,22 @@
 import os
 import re
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
 
 from llama_parse import LlamaParse
-from pymupdf import Document, Rect
+from pymupdf import Document, Rect, TextPage
+
+from atomic_io import write_text_atomically
+from parse_cache import parse_cache
+
+# text columns of the 4th chapter pages (col_separators = [40, 230, 420, 610]), read left to right
+COLUMN_RECTS = ((40, 30, 230, 755), (230, 30, 420, 755), (420, 30, 610, 755))
+# PDFs are extracted in page ranges of PDF_PAGES_PER_SHARD pages by PDF_EXTRACT_WORKERS processes
+PDF_EXTRACT_WORKERS = int(os.getenv("PDF_EXTRACT_WORKERS", os.cpu_count() or 1))
+PDF_PAGES_PER_SHARD = int(os.getenv("PDF_PAGES_PER_SHARD", 16))
+# offline stand-in for LlamaParse (plain PyMuPDF text), its parses are cached apart from the real ones
+LLAMA_PARSE_STUB = os.getenv("LLAMA_PARSE_STUB", "false").lower() == "true"
+LLAMA_PARSER_NAME = "llama_parse_stub" if LLAMA_PARSE_STUB else "llama_parse"
 
 
 def name_divider_util(name: str, part: int):
@@ -10,44 +24,156 @@ def name_divider_util(name: str, part: int):
     return f"{'_'.join(split_name[:3])}.{part}_{split_name[3]}"
 
 
+DESCRIPTION = "Description"
+DESCRIPTION_PATTERN = re.compile(r'\bDescription\b')
+DOUBLE_HASH_TERMS = [
+    "Habitat & Cultivation", "Parts Used", "Constituents", "History & Folklore", "Research", "Part Used",
+    "Medicinal Actions & Uses", "Cautions", "Caution", "Related Species", "Self-help Use",
+    "RCautions", "RCaution", "QCaution", "QCautions", "RQCaution", "RQCautions",  # <- read caution alternations
+]
+DOUBLE_HASH_PATTERN = re.compile(r'\b(?:' + '|'.join(re.escape(term) for term in DOUBLE_HASH_TERMS) + r')\b')
+
+
 def transform_text_to_markdown(text: str):
-    double_hash_terms = [
-        "Habitat & Cultivation", "Parts Used", "Constituents", "History & Folklore", "Research", "Part Used",
-        "Medicinal Actions & Uses", "Cautions", "Caution", "Related Species", "Self-help Use",
-        "RCautions", "RCaution", "QCaution", "QCautions", "RQCaution", "RQCautions",  # <- read caution alternations
-    ]
-    # Create regex pattern for the double hash terms
-    double_hash_pattern = r'\b(?:' + '|'.join(re.escape(term) for term in double_hash_terms) + r')\b'
-    # Add single hash before plant names (text between start and 'Description')
-    # (?<=\n)(.*?)(?= Description)
-    d_str = "Description"
-    d_pattern = r'\n*([^.]*)\bDescription\b'
-    s = re.sub(d_pattern, lambda m: '\n# ' + m.group().replace('\n', ' ').replace(d_str, "\n## " + d_str + "\n"), text)
+    # Add single hash before plant names: text of a sentence (no dots) up to its last 'Description' word
+    # becomes a header, done in one forward scan instead of a backtracking regex from every position
+    parts = []
+    position = 0
+    for match in DESCRIPTION_PATTERN.finditer(text):
+        if match.start() < position:
+            continue
+        last_dot = text.rfind(".", position, match.start())
+        header_start = position if last_dot == -1 else last_dot + 1
+        sentence_end = text.find(".", match.end())
+        header_end = _last_description_end(text, match.end(), len(text) if sentence_end == -1 else sentence_end)
+        header = text[header_start:header_end].replace('\n', ' ').replace(DESCRIPTION, "\n## " + DESCRIPTION + "\n")
+        parts.append(text[position:header_start])
+        parts.append('\n# ' + header)
+        position = header_end
+    parts.append(text[position:])
     # Add double hash before each term in the double hash list (excluding "Description")
-    s = re.sub(double_hash_pattern, r'## \g<0>\n', s)
-    return s
+    return DOUBLE_HASH_PATTERN.sub(r'## \g<0>\n', "".join(parts))
+
+
+def _last_description_end(text: str, first_end: int, sentence_end: int) -> int:
+    # end of the last whole 'Description' word of the sentence
+    last_end = first_end
+    for match in DESCRIPTION_PATTERN.finditer(text, first_end, sentence_end):
+        last_end = match.end()
+    return last_end
+
+
+def extract_columns_text(textpage: TextPage, column_rects: tuple) -> list[str]:
+    """
+    Cuts the text of every column out of a single pass over the characters of a page.
+
+    Gives the same text as page.get_textbox(rect) per column, which goes through all characters of the page
+    for every column: characters overlapping a column are kept and lines of the page are separated by newlines.
+    """
+    columns = [Rect(*rect) for rect in column_rects]
+    columns_text = [[] for _ in columns]
+    need_new_line = [False] * len(columns)
+    for block in textpage.extractRAWDICT()["blocks"]:
+        if block["type"] != 0:  # image blocks
+            continue
+        for line in block["lines"]:
+            line_had_text = [False] * len(columns)
+            for span in line["spans"]:
+                for char in span["chars"]:
+                    x0, y0, x1, y1 = char["bbox"]
+                    for i, column in enumerate(columns):
+                        if x0 < column.x1 and x1 > column.x0 and y0 < column.y1 and y1 > column.y0:
+                            if need_new_line[i]:
+                                columns_text[i].append("\n")
+                                need_new_line[i] = False
+                            columns_text[i].append(char["c"])
+                            line_had_text[i] = True
+            for i, had_text in enumerate(line_had_text):
+                need_new_line[i] = need_new_line[i] or had_text
+    return ["".join(column_text) for column_text in columns_text]
 
 
-def load_document_by_pymupdf(pdf_source_path: str, output_file_path: str) -> str:
-    # 3 columns starting/ending coordinates
-    # col_separators = [40, 230, 420, 610]
-    if os.path.exists(output_file_path):
-        with open(output_file_path, 'r', encoding="utf-8") as f:
-            doc = f.read()
+def extract_pages_text(pdf_source_path: str, first_page: int, last_page: int,
+                       column_rects: tuple = COLUMN_RECTS) -> str:
+    # runs in extraction worker processes, a PyMuPDF document can't be shared between them
+    pdf_doc = Document(pdf_source_path)
+    try:
+        pages_text = []
+        for page in pdf_doc.pages(first_page, last_page):
+            columns_text = extract_columns_text(page.get_textpage(), column_rects)
+            pages_text.append("\n" + "\n".join(columns_text))
+        return "".join(pages_text)
+    finally:
+        pdf_doc.close()
+
+
+def extract_pdf_text(pdf_source_path: str, workers: int = PDF_EXTRACT_WORKERS,
+                     pages_per_shard: int = PDF_PAGES_PER_SHARD) -> str:
+    pdf_doc = Document(pdf_source_path)
+    page_count = pdf_doc.page_count
+    pdf_doc.close()
+    shards = [(first_page, min(first_page + pages_per_shard, page_count))
+              for first_page in range(0, page_count, pages_per_shard)]
+    if workers > 1 and len(shards) > 1:
+        # page ranges are extracted in parallel, map() returns them in page order
+        with ProcessPoolExecutor(max_workers=min(workers, len(shards))) as executor:
+            shards_text = list(executor.map(extract_pages_text, repeat(pdf_source_path),
+                                            *zip(*shards), repeat(COLUMN_RECTS)))
     else:
-        pdf_doc = Document(pdf_source_path)
-        doc = ""
-        with open(output_file_path, 'a+', encoding="utf-8") as f:
-            for page in pdf_doc.pages():
-                page_text = "\n"
-                page_text += page.get_textbox(Rect(40, 30, 230, 755)) + "\n"
-                page_text += page.get_textbox(Rect(230, 30, 420, 755)) + "\n"
-                page_text += page.get_textbox(Rect(420, 30, 610, 755))
-                f.write(page_text)
-                doc += page_text
+        shards_text = [extract_pages_text(pdf_source_path, first_page, last_page) for first_page, last_page in shards]
+    return "".join(shards_text)
+
+
+def cached_parse(pdf_source_path: str, output_file_path: str, parser_name: str, parser_options: dict, parse,
+                 md_file_path: str = None) -> str:
+    """
+    Parses a PDF through the parse cache, exports the text to output_file_path and its markdown to md_file_path.
+
+    Args:
+        pdf_source_path (str): PDF to parse
+        output_file_path (str): Text export of the parse
+        parser_name (str): Name of the parser, a part of the cache key
+        parser_options (dict): Everything else changing the parser output, a part of the cache key
+        parse: Function parsing the PDF, called on cache misses only
+        md_file_path (str): Markdown export, kept while the PDF & parser options stay the same
+
+    Returns:
+        str: Existing markdown when it's up to date, parsed text otherwise. Without the PDF, the existing markdown
+        or text export
+    """
+    if not os.path.exists(pdf_source_path):
+        # only the exports are at hand, a missing markdown is made from the text export
+        if md_file_path and os.path.exists(md_file_path):
+            with open(md_file_path, 'r', encoding="utf-8") as f:
+                return f.read()
+        if os.path.exists(output_file_path):
+            with open(output_file_path, 'r', encoding="utf-8") as f:
+                doc = f.read()
+            if md_file_path:
+                write_text_atomically(md_file_path, transform_text_to_markdown(doc))
+            return doc
+    key = parse_cache.parse_key(pdf_source_path, parser_name, parser_options)
+    if md_file_path and parse_cache.is_output_current(md_file_path, key):
+        with open(md_file_path, 'r', encoding="utf-8") as f:
+            return f.read()
+    doc = parse_cache.get_or_parse(key, parse, {"source": pdf_source_path, "parser": parser_name,
+                                                "options": parser_options})
+    parse_cache.export(output_file_path, key, doc)
+    if md_file_path:
+        parse_cache.export(md_file_path, key, transform_text_to_markdown(doc))
     return doc
 
 
+def pymupdf_options() -> dict:
+    return {"column_rects": [list(rect) for rect in COLUMN_RECTS]}
+
+
+def load_document_by_pymupdf(pdf_source_path: str, output_file_path: str, workers: int = PDF_EXTRACT_WORKERS,
+                             pages_per_shard: int = PDF_PAGES_PER_SHARD) -> str:
+    return cached_parse(pdf_source_path, output_file_path, "pymupdf", pymupdf_options(),
+                        lambda: extract_pdf_text(pdf_source_path, workers, pages_per_shard))
+
+
 def load_multiple_docs_with_pymupdf(names: list[str], merge_docs=False):
     docs = []
     merged_doc_name = "_".join(names[0][:3]) + '_' + names[0][4]
@@ -57,50 +183,67 @@ def load_multiple_docs_with_pymupdf(names: list[str], merge_docs=False):
         del split_name[3]
         pages_part = f"_p{pages[0]}-{pages[1]}_"
         file_name = "_".join(split_name[:3]) + pages_part + split_name[3]
-        if os.path.exists(f"./data_store/{file_name}.md"):
-            with open(f"./data_store/{file_name}.md", 'r', encoding="utf-8") as f:
-                doc = f.read()
-        else:
-            doc = load_document_by_pymupdf(f"./raw_docs/{file_name}.pdf", f"./data_store/{file_name}.txt")
-            output = transform_text_to_markdown(doc)
-            with open(f"./data_store/{file_name}.md", 'w', encoding="utf-8") as f:
-                f.write(output)
+        pdf_source_path = f"./raw_docs/{file_name}.pdf"
+        doc = cached_parse(pdf_source_path, f"./data_store/{file_name}.txt", "pymupdf", pymupdf_options(),
+                           lambda: extract_pdf_text(pdf_source_path), md_file_path=f"./data_store/{file_name}.md")
         docs.append(doc)
     if merge_docs:
-        with open(f"./data_store/{merged_doc_name}.md", 'w', encoding="utf-8") as f:
-            for doc in docs:
-                f.write(doc+"\n")
+        write_text_atomically(f"./data_store/{merged_doc_name}.md", "".join(doc + "\n" for doc in docs))
     return docs
 
 
+class StubLlamaParse:
+    """Offline stand-in for LlamaParse in tests, returns the plain text of the PDF pages."""
+
+    class ParsedDocument:
+        def __init__(self, text: str):
+            self.text = text
+
+        def get_content(self) -> str:
+            return self.text
+
+    def __init__(self, **kwargs):
+        self.options = kwargs
+
+    def load_data(self, pdf_source_path: str) -> list:
+        pdf_doc = Document(pdf_source_path)
+        try:
+            return [self.ParsedDocument("\n".join(page.get_text() for page in pdf_doc))]
+        finally:
+            pdf_doc.close()
+
+
+def parse_with_llama_parse(pdf_source_path: str, parsing_instruction: str, use_gpt4o: bool) -> str:
+    parser_class = StubLlamaParse if LLAMA_PARSE_STUB else LlamaParse
+    parser = parser_class(
+        api_key="" if LLAMA_PARSE_STUB else os.environ["LLAMA_CLOUD_KEY"],
+        result_type="markdown",
+        parsing_instruction=parsing_instruction,
+        gpt4o_mode=use_gpt4o,
+        max_timeout=5000,
+        ignore_errors=False
+        )
+    llama_parse_doc = parser.load_data(pdf_source_path)[0]
+    return llama_parse_doc.get_content()
+
+
+def llama_parse_options(parsing_instruction: str, use_gpt4o: bool) -> dict:
+    return {"parsing_instruction": parsing_instruction, "result_type": "markdown", "gpt4o_mode": use_gpt4o}
+
+
 def load_document_by_llama_parse(pdf_source_path: str, output_file_path: str, parsing_instruction: str, use_gpt4o: bool) -> str:
-    if os.path.exists(output_file_path):
-        with open(output_file_path, 'r', encoding="utf-8") as f:
-            doc = f.read()
-    else:
-        parser = LlamaParse(
-            api_key=os.environ["LLAMA_CLOUD_KEY"],
-            result_type="markdown",
-            parsing_instruction=parsing_instruction,
-            gpt4o_mode=use_gpt4o,
-            max_timeout=5000,
-            ignore_errors=False
-            )
-        llama_parse_doc = parser.load_data(pdf_source_path)[0]
-        doc = llama_parse_doc.get_content()
-    return doc
+    return cached_parse(pdf_source_path, output_file_path, LLAMA_PARSER_NAME,
+                        llama_parse_options(parsing_instruction, use_gpt4o),
+                        lambda: parse_with_llama_parse(pdf_source_path, parsing_instruction, use_gpt4o))
 
 
 def load_single_doc_with_llama_parse(part_name: str, parsing_instr=""):
-    if os.path.exists(f"./data_store/{part_name}.md"):
-        with open(f"./data_store/{part_name}.md", 'r', encoding="utf-8") as f:
-            doc = f.read()
-    else:
-        doc = load_document_by_llama_parse(f"./raw_docs/{part_name}.pdf", f"./data_store/{part_name}.txt", parsing_instr, True)
-        output = transform_text_to_markdown(doc)
-        with open(f"./data_store/{part_name}.md", 'w', encoding="utf-8") as f:
-            f.write(output)
-    return doc
+    pdf_source_path = f"./raw_docs/{part_name}.pdf"
+    return cached_parse(pdf_source_path, f"./data_store/{part_name}.txt",
+                        LLAMA_PARSER_NAME,
+                        llama_parse_options(parsing_instr, True),
+                        lambda: parse_with_llama_parse(pdf_source_path, parsing_instr, True),
+                        md_file_path=f"./data_store/{part_name}.md")
 
 
 # LLAMA PARSE PDF PARSER INSTRUCTIONS
@@ -1,66 +1,384 @@
 import os
+import json
+import time
 import uuid
 import logging
+import threading
+from itertools import islice
+from typing import Iterable
+from concurrent.futures import Executor, ThreadPoolExecutor, FIRST_COMPLETED, wait
 
-from InstructorEmbedding import INSTRUCTOR
-from qdrant_client import QdrantClient, models
-from qdrant_client.http.exceptions import ResponseHandlingException
+import numpy as np
+from qdrant_client import models
+from qdrant_client.http.exceptions import ResponseHandlingException, UnexpectedResponse
+
+from resource_pool import resource_pool
+from embedding_cache import EmbeddingCache, embedding_cache, sentence_cache
+from semantic_cache import answer_cache, bump_collection_version
+from ingest_manifest import IngestManifest, chunk_content_hash, chunk_point_id
+from sparse_index import reciprocal_rank_fusion
+from tracing import record_stage
+
+# ingestion tuning: chunks per INSTRUCTOR.encode call, points per upsert request & parallel upload workers
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", 32))
+UPSERT_BATCH_SIZE = int(os.getenv("UPSERT_BATCH_SIZE", 64))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", 2))
+UPSERT_RETRIES = int(os.getenv("UPSERT_RETRIES", 3))
+UPSERT_RETRY_BACKOFF = float(os.getenv("UPSERT_RETRY_BACKOFF", 1.0))
+
+QUERY_INSTRUCTION = "Represent the question for retrieving supporting documents: "
+SENTENCE_INSTRUCTION = "Represent the Natural remedies sentence for retrieval: "
+
+# search modes: "exact" (brute force scan), "hnsw" (approximate, recall tuned by hnsw_ef)
+# or "quantized" (HNSW over quantized vectors, rescored with the original ones)
+SEARCH_MODE = os.getenv("QDRANT_SEARCH_MODE", "exact")
+HNSW_EF = int(os.getenv("QDRANT_HNSW_EF", 128))
+RESCORE_OVERSAMPLING = float(os.getenv("QDRANT_RESCORE_OVERSAMPLING", 2.0))
+# per collection overrides, e.g. {"medical_herbs_rag_instructor_embeddings": {"mode": "hnsw", "hnsw_ef": 64,
+# "hybrid": false}}
+COLLECTION_SEARCH_CONFIG = json.loads(os.getenv("QDRANT_COLLECTION_SEARCH_CONFIG", "{}"))
+
+
+def build_search_params(mode: str, hnsw_ef: int, oversampling: float) -> models.SearchParams:
+    if mode == "exact":
+        return models.SearchParams(hnsw_ef=hnsw_ef, exact=True)
+    if mode == "hnsw":
+        return models.SearchParams(
+            hnsw_ef=hnsw_ef,
+            exact=False,
+            quantization=models.QuantizationSearchParams(ignore=True)
+        )
+    if mode == "quantized":
+        return models.SearchParams(
+            hnsw_ef=hnsw_ef,
+            exact=False,
+            quantization=models.QuantizationSearchParams(ignore=False, rescore=True, oversampling=oversampling)
+        )
+    raise ValueError(f"Unknown search mode: {mode}")
+
+# quantization of new collections: "none", "scalar" (int8) or "binary"
+QUANTIZATION = os.getenv("QDRANT_QUANTIZATION", "none")
+
+
+def build_quantization_config(quantization: str):
+    if quantization in (None, "none"):
+        return None
+    if quantization == "scalar":
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(type=models.ScalarType.INT8, quantile=0.99, always_ram=True)
+        )
+    if quantization == "binary":
+        return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+    raise ValueError(f"Unknown quantization: {quantization}")
+
+# hybrid retrieval: dense & BM25 keyword results fused with reciprocal rank fusion
+HYBRID_SEARCH = os.getenv("HYBRID_SEARCH", "true").lower() == "true"
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 20))
+HYBRID_DENSE_THRESHOLD = float(os.getenv("HYBRID_DENSE_THRESHOLD", 0.8))
+# keyword hits: terms in more than about a third of the chunks (IDF < 1) don't count, hits below half of the top
+# BM25 score are dropped, keyword-only hits need a cosine score of at least the level of unrelated INSTRUCTOR texts
+HYBRID_SPARSE_MIN_IDF = float(os.getenv("HYBRID_SPARSE_MIN_IDF", 1.0))
+HYBRID_SPARSE_MIN_SCORE_RATIO = float(os.getenv("HYBRID_SPARSE_MIN_SCORE_RATIO", 0.5))
+HYBRID_KEYWORD_MIN_SCORE = float(os.getenv("HYBRID_KEYWORD_MIN_SCORE", 0.7))
+
+
+def chunk_payload(doc_name: str, chunk) -> dict:
+    return {
+        "ebook_chapter": doc_name,
+        "content": chunk.page_content,
+        "tags": chunk.metadata
+    }
+
+
+def point_key(point_id) -> str:
+    # Qdrant returns UUIDs with dashes, the manifest & keyword index keep them as hex
+    return uuid.UUID(str(point_id)).hex
+
+
+def cosine_similarity(vector, other_vector) -> float:
+    vector = np.asarray(vector, dtype=np.float32)
+    other_vector = np.asarray(other_vector, dtype=np.float32)
+    norms = np.linalg.norm(vector) * np.linalg.norm(other_vector)
+    return float(vector @ other_vector / norms) if norms else 0.0
+
+
+def batched(items: Iterable, size: int):
+    iterator = iter(items)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+# guards read-modify-write of manifests by chapters finishing at the same time
+manifest_lock = threading.Lock()
+
+
+class DocumentIngest:
+    """Chunk hashes, pending upserts & timings of a chapter between its embedding and finish_document()."""
+
+    def __init__(self, doc_name: str, ingested_hashes: dict[str, str]):
+        self.doc_name = doc_name
+        self.ingested_hashes = ingested_hashes
+        self.current_hashes = {}
+        self.pending = set()
+        self.failed_ids = []
+        self.chunks_count = 0
+        self.embed_seconds = 0.0
+        self.upsert_seconds = 0.0
+        self.start_time = time.perf_counter()
+
+    def collect(self, futures: Iterable):
+        for future in futures:
+            failed_ids, seconds = future.result()
+            self.failed_ids.extend(failed_ids)
+            self.upsert_seconds += seconds
 
 
 class QdrantManager:
-    def __init__(self, collection_name: str):
+    def __init__(self, collection_name: str, search_mode: str = None, hnsw_ef: int = None, oversampling: float = None,
+                 hybrid: bool = None):
         self.collection_name = collection_name
-        self.qdrant_client = QdrantClient(
-            url=os.getenv("QDRANT_DB_URL"),
-            api_key=os.getenv("QDRANT_KEY")
+        self.vector_store = resource_pool.get_vector_store(collection_name)
+        self.sparse_index = resource_pool.get_sparse_index(collection_name)
+        self.model = resource_pool.get_embedding_model()
+        search_config = COLLECTION_SEARCH_CONFIG.get(collection_name, {})
+        self.search_params = build_search_params(
+            mode=search_mode or search_config.get("mode", SEARCH_MODE),
+            hnsw_ef=hnsw_ef or search_config.get("hnsw_ef", HNSW_EF),
+            oversampling=oversampling or search_config.get("oversampling", RESCORE_OVERSAMPLING)
         )
-        self.model = INSTRUCTOR(os.getenv("INSTRUCTOR_LOCAL_PATH"))
-
-    def create_vector_collection(self):
-        if not self.qdrant_client.collection_exists(self.collection_name):
-            self.qdrant_client.create_collection(
-                collection_name=self.collection_name,
-                vectors_config=models.VectorParams(
-                    size=768,
-                    distance=models.Distance.COSINE,
-                    datatype=models.Datatype.FLOAT32,  # UINT8 made vectors filled with zeros (too little precision)
+        self.hybrid = search_config.get("hybrid", HYBRID_SEARCH) if hybrid is None else hybrid
+
+    def create_vector_collection(self, quantization: str = QUANTIZATION):
+        if not self.vector_store.collection_exists():
+            self.vector_store.create_collection(size=768, quantization_config=build_quantization_config(quantization))
+            # a fresh collection has none of the points recorded in an old manifest & keyword index
+            IngestManifest(self.collection_name).clear()
+            self.sparse_index.clear()
+
+    def populate_vector_collection(self, doc_name: str, doc_specifier: str, doc_chunks: Iterable,
+                                   embed_batch_size: int = EMBED_BATCH_SIZE, upsert_batch_size: int = UPSERT_BATCH_SIZE,
+                                   upload_workers: int = UPLOAD_WORKERS) -> dict:
+        with ThreadPoolExecutor(max_workers=upload_workers) as executor:
+            # at most 2 batches per worker wait in the queue, so embedding doesn't run ahead of the uploads
+            ingest = self.embed_document(doc_name, doc_specifier, doc_chunks, executor, embed_batch_size,
+                                         upsert_batch_size, max_pending=2 * upload_workers)
+            return self.finish_document(ingest)
+
+    def embed_document(self, doc_name: str, doc_specifier: str, doc_chunks: Iterable, upload_executor: Executor,
+                       embed_batch_size: int = EMBED_BATCH_SIZE, upsert_batch_size: int = UPSERT_BATCH_SIZE,
+                       max_pending: int = 2 * UPLOAD_WORKERS) -> DocumentIngest:
+        """
+        Embeds new & changed chunks of a chapter in batches and submits their upserts to upload_executor.
+
+        Args:
+            upload_executor (Executor): Runs the upserts, may be shared by chapters embedded at the same time
+            max_pending (int): Max number of the chapter's upserts waiting in upload_executor before embedding waits
+
+        Returns:
+            DocumentIngest: Ingest to pass to finish_document() once the chapter is embedded
+        """
+        doc_instruction = f"Represent the {doc_specifier} Natural remedies paragraph for retrieval: "
+        ingest = DocumentIngest(doc_name, IngestManifest(self.collection_name).get(doc_name))
+
+        def new_chunks():
+            # point IDs come from the chunk content, so unchanged chunks are neither embedded nor upserted again
+            for chunk in doc_chunks:
+                content_hash = chunk_content_hash(doc_instruction, chunk.page_content, chunk.metadata)
+                point_id = chunk_point_id(doc_name, content_hash)
+                if point_id in ingest.current_hashes:
+                    continue
+                ingest.current_hashes[point_id] = content_hash
+                if point_id not in self.sparse_index:  # keyword index is filled up for collections ingested without it
+                    self.sparse_index.add(point_id, chunk.page_content, chunk_payload(doc_name, chunk))
+                if point_id not in ingest.ingested_hashes:
+                    yield point_id, chunk
+
+        for chunks_batch in batched(new_chunks(), embed_batch_size):
+            embed_start = time.perf_counter()
+            vectors = self.model.encode(
+                sentences=[f'{doc_instruction} """ {chunk.page_content} """' for _, chunk in chunks_batch],
+                batch_size=embed_batch_size
+            )
+            ingest.embed_seconds += time.perf_counter() - embed_start
+            points = [models.PointStruct(
+                id=point_id,
+                payload=chunk_payload(doc_name, chunk),
+                vector=vector.tolist()
+            ) for (point_id, chunk), vector in zip(chunks_batch, vectors)]
+            ingest.chunks_count += len(points)
+            for points_batch in batched(points, upsert_batch_size):
+                ingest.pending.add(upload_executor.submit(self._timed_upsert, points_batch))
+                if len(ingest.pending) >= max_pending:
+                    done, ingest.pending = wait(ingest.pending, return_when=FIRST_COMPLETED)
+                    ingest.collect(done)
+        return ingest
+
+    def finish_document(self, ingest: DocumentIngest) -> dict:
+        """Waits for the chapter's upserts, removes chunks gone from the chapter & records the ingest."""
+        ingest.collect(ingest.pending)
+        ingest.pending = set()
+        doc_name = ingest.doc_name
+        current_hashes = ingest.current_hashes
+        failed_ids = ingest.failed_ids
+        chunks_count = ingest.chunks_count
+
+        removed_ids = [point_id for point_id in ingest.ingested_hashes if point_id not in current_hashes]
+        if removed_ids:
+            self.vector_store.delete(removed_ids)
+        self.vector_store.flush()
+        for point_id in failed_ids:  # not recorded, so they're retried on the next run
+            current_hashes.pop(point_id, None)
+        self.sparse_index.remove(removed_ids + failed_ids)
+        self.sparse_index.save()
+        # chapters of a collection can finish concurrently, each one updates the latest manifest
+        with manifest_lock:
+            manifest = IngestManifest(self.collection_name)
+            manifest.update(doc_name, current_hashes)
+            manifest.save()
+
+        elapsed = time.perf_counter() - ingest.start_time
+        throughput = chunks_count / elapsed if elapsed else 0.0
+        logging.log(logging.INFO, f"{doc_name}: {chunks_count} new chunks ({len(failed_ids)} failed), "
+                                  f"{len(current_hashes) - chunks_count + len(failed_ids)} unchanged, "
+                                  f"{len(removed_ids)} removed in {elapsed:.2f}s, {throughput:.1f} chunks/sec")
+        if chunks_count or removed_ids:
+            # cached answers were built from the previous collection content
+            answer_cache.invalidate(self.collection_name)
+            bump_collection_version(self.collection_name)
+        return {
+            "chunks": chunks_count,
+            "failed": len(failed_ids),
+            "removed": len(removed_ids),
+            "seconds": elapsed,
+            "chunks_per_sec": throughput,
+            "embed_seconds": ingest.embed_seconds,
+            "upsert_seconds": ingest.upsert_seconds
+        }
+
+    def _timed_upsert(self, points: list[models.PointStruct]) -> tuple[list[str], float]:
+        start = time.perf_counter()
+        failed_ids = self._upsert_with_retries(points)
+        return failed_ids, time.perf_counter() - start
+
+    def _upsert_with_retries(self, points: list[models.PointStruct]) -> list[str]:
+        for attempt in range(UPSERT_RETRIES):
+            try:
+                self.vector_store.upsert(points)
+                return []
+            except (ResponseHandlingException, UnexpectedResponse) as e:
+                logging.warning(f"Upsert of {len(points)} points failed (attempt {attempt + 1}/{UPSERT_RETRIES}): {e}")
+                if attempt + 1 < UPSERT_RETRIES:
+                    time.sleep(UPSERT_RETRY_BACKOFF * 2 ** attempt)
+        logging.error(f"Upsert of {len(points)} points to {self.collection_name} failed, points skipped")
+        return [point.id for point in points]
+
+    def embed_query(self, query: str):
+        with record_stage("embed"):
+            return embedding_cache.get_or_compute(
+                QUERY_INSTRUCTION, query,
+                lambda: self.model.encode(f'{QUERY_INSTRUCTION} """ {query} """')
+            )
+
+    def embed_queries(self, queries: list[str]) -> list:
+        return self._embed_texts(embedding_cache, QUERY_INSTRUCTION, queries)
+
+    def embed_sentences(self, sentences: list[str]) -> list:
+        return self._embed_texts(sentence_cache, SENTENCE_INSTRUCTION, sentences)
+
+    def _embed_texts(self, cache: EmbeddingCache, instruction: str, texts: list[str]) -> list:
+        # texts missing in the cache are encoded with a single model call
+        vectors = [cache.get(instruction, text) for text in texts]
+        missing = [i for i, vector in enumerate(vectors) if vector is None]
+        if missing:
+            with record_stage("embed"):
+                encoded = self.model.encode([f'{instruction} """ {texts[i]} """' for i in missing])
+            for i, vector in zip(missing, encoded):
+                cache.put(instruction, texts[i], vector)
+                vectors[i] = vector
+        return vectors
+
+    def make_query(self, query: str, query_vector=None):
+        return [answer.payload for answer in self.query_points(query, query_vector)]
+
+    def query_points(self, query: str, query_vector=None, limit: int = 8,
+                     with_vectors: bool = False) -> list[models.ScoredPoint]:
+        np_vector = self.embed_query(query) if query_vector is None else query_vector
+        if self.hybrid:
+            return self.hybrid_query(query, np_vector, limit=limit, with_vectors=with_vectors)
+        return self.search(np_vector, limit=limit, score_threshold=0.8, with_vectors=with_vectors)
+
+    def query_points_batch(self, queries: list[str], query_vectors: list, limit: int = 8,
+                           with_vectors: bool = False) -> list[list[models.ScoredPoint]]:
+        if self.hybrid:
+            with record_stage("search"):
+                dense_results = self.vector_store.search_batch(
+                    query_vectors,
+                    limit=HYBRID_CANDIDATES,
+                    score_threshold=HYBRID_DENSE_THRESHOLD,
+                    search_params=self.search_params,
+                    with_vectors=with_vectors
                 )
+            return [self.hybrid_query(query, query_vector, limit=limit, with_vectors=with_vectors,
+                                      dense_results=query_dense_results)
+                    for query, query_vector, query_dense_results in zip(queries, query_vectors, dense_results)]
+        with record_stage("search"):
+            return self.vector_store.search_batch(
+                query_vectors,
+                limit=limit,
+                score_threshold=0.8,
+                search_params=self.search_params,
+                with_vectors=with_vectors
             )
 
-    def populate_vector_collection(self, doc_name: str, doc_specifier: str, doc_chunks: list):
-        doc_instruction = f"Represent the {doc_specifier} Natural remedies paragraph for retrieval: "
-        try:  # upsert has a limit of processing chunks extracted from files with +5000 lines & may return an error
-            self.qdrant_client.upsert(
-                collection_name=self.collection_name,
-                points=[models.PointStruct(
-                    id=uuid.uuid4().hex,
-                    payload={
-                        "ebook_chapter": doc_name,
-                        "content": chunk.page_content,
-                        "tags": chunk.metadata
-                    },
-                    vector=self.model.encode(
-                        sentences=(f'{doc_instruction} """ {chunk.page_content} """')
+    def hybrid_query(self, query: str, query_vector, limit: int, with_vectors: bool = False,
+                     dense_results: list[models.ScoredPoint] = None) -> list[models.ScoredPoint]:
+        # dense results keep their threshold, keyword hits fill in exact names the dense search scores too low
+        if dense_results is None:
+            dense_results = self.search(query_vector, limit=HYBRID_CANDIDATES, score_threshold=HYBRID_DENSE_THRESHOLD,
+                                        with_vectors=with_vectors)
+        with record_stage("search"):
+            self.sparse_index.refresh()
+            sparse_results = self.sparse_index.search(query, limit=HYBRID_CANDIDATES, min_idf=HYBRID_SPARSE_MIN_IDF,
+                                                      min_score_ratio=HYBRID_SPARSE_MIN_SCORE_RATIO)
+
+        points = {point_key(point.id): point for point in dense_results}
+        keyword_only_ids = [point_key(point_id) for point_id, _, _ in sparse_results
+                            if point_key(point_id) not in points]
+        if keyword_only_ids:
+            # vectors of keyword-only hits give them a cosine score comparable with the dense ones, off-topic hits
+            # below HYBRID_KEYWORD_MIN_SCORE & hits missing in the vector store are left out of the fusion
+            with record_stage("search"):
+                records = self.vector_store.retrieve(keyword_only_ids, with_vectors=True)
+            for record in records:
+                score = cosine_similarity(query_vector, record.vector)
+                if score >= HYBRID_KEYWORD_MIN_SCORE:
+                    points[point_key(record.id)] = models.ScoredPoint(
+                        id=record.id,
+                        version=0,
+                        score=score,
+                        payload=record.payload,
+                        vector=record.vector if with_vectors else None
                     )
-                ) for chunk in doc_chunks]
+        fused_ids = reciprocal_rank_fusion([
+            [point_key(point.id) for point in dense_results],
+            [point_key(point_id) for point_id, _, _ in sparse_results if point_key(point_id) in points]
+        ])[:limit]
+        return [points[point_id] for point_id in fused_ids]
+
+    def search(self, query_vector, limit: int, score_threshold: float = None, search_params: models.SearchParams = None,
+               with_vectors: bool = False) -> list[models.ScoredPoint]:
+        with record_stage("search"):
+            return self.vector_store.search(
+                query_vector,
+                limit=limit,
+                score_threshold=score_threshold,
+                search_params=search_params or self.search_params,
+                with_vectors=with_vectors
             )
-        except ResponseHandlingException as e:
-            logging.exception(e.source)
-
-    def make_query(self, query: str):
-        query_instruction = "Represent the question for retrieving supporting documents: "
-        np_vector = self.model.encode(f'{query_instruction} """ {query} """')
-        results = self.qdrant_client.search(
-            collection_name=self.collection_name,
-            query_vector=np_vector,
-            search_params=models.SearchParams(hnsw_ef=128, exact=True),
-            score_threshold=0.8,
-            limit=8
-        )
-        return [answer.payload for answer in results]
 
     def get_records_by_ids(self, recs_ids: list[str]):
-        return self.qdrant_client.retrieve(self.collection_name, recs_ids, with_vectors=True)
+        return self.vector_store.retrieve(recs_ids, with_vectors=True)
 
     def close(self):
-        self.qdrant_client.close()
+        # vector store & model are shared by the whole process, they're released by resource_pool.shutdown()
+        pass
@@ -0,0 +1,44 @@
+import numpy as np
+
+
+def mmr_select(query_vector, doc_vectors: list, top_n: int, lambda_mult: float = 0.7,
+               duplicate_threshold: float = 0.97) -> list[int]:
+    """
+    Picks the most relevant & mutually diverse documents with maximal marginal relevance.
+
+    Args:
+        query_vector: Embedding of the question
+        doc_vectors (list): Embeddings of the retrieved documents
+        top_n (int): Max number of selected documents
+        lambda_mult (float): Weight of relevance to the question vs diversity from already selected documents
+        duplicate_threshold (float): Cosine similarity above which a document counts as a near-duplicate of a selected one
+
+    Returns:
+        list[int]: Indices of selected documents, in selection order (most relevant first)
+    """
+    if not doc_vectors:
+        return []
+    docs = normalize_rows(np.asarray(doc_vectors, dtype=np.float32))
+    query = normalize_rows(np.asarray(query_vector, dtype=np.float32)[None, :])[0]
+    relevance = docs @ query
+    similarity = docs @ docs.T
+
+    selected = []
+    candidates = list(range(len(docs)))
+    while candidates and len(selected) < top_n:
+        if selected:
+            redundancy = similarity[np.ix_(candidates, selected)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(candidates), dtype=np.float32)
+        mmr_scores = lambda_mult * relevance[candidates] - (1 - lambda_mult) * redundancy
+        best = candidates.pop(int(np.argmax(mmr_scores)))
+        if selected and similarity[best, selected].max() >= duplicate_threshold:
+            continue
+        selected.append(best)
+    return selected
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
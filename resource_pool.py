@@ -0,0 +1,101 @@
+import os
+import logging
+import threading
+
+from InstructorEmbedding import INSTRUCTOR
+from qdrant_client import QdrantClient
+
+from vector_stores import VectorStore, QdrantVectorStore, LocalVectorStore
+from sparse_index import BM25Index
+
+# "qdrant" (remote Qdrant at QDRANT_DB_URL) or "local" (in-process index memory-mapped from LOCAL_INDEX_DIR)
+VECTOR_STORE_BACKEND = os.getenv("VECTOR_STORE_BACKEND", "qdrant")
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "./data_store/local_index")
+
+
+class ResourcePool:
+    """
+    Process-wide holder of heavy, reusable resources.
+
+    The INSTRUCTOR model is loaded once per process, Qdrant clients, vector stores & keyword indexes are kept
+    open per collection, so graph nodes and ETL runs reuse them instead of rebuilding them on every call.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._model = None
+        self._qdrant_clients = {}
+        self._vector_stores = {}
+        self._sparse_indexes = {}
+
+    def get_embedding_model(self) -> INSTRUCTOR:
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    logging.log(logging.INFO, "Loading INSTRUCTOR embedding model")
+                    self._model = INSTRUCTOR(os.getenv("INSTRUCTOR_LOCAL_PATH"))
+        return self._model
+
+    def get_qdrant_client(self, collection_name: str) -> QdrantClient:
+        client = self._qdrant_clients.get(collection_name)
+        if client is None:
+            with self._lock:
+                client = self._qdrant_clients.get(collection_name)
+                if client is None:
+                    client = QdrantClient(
+                        url=os.getenv("QDRANT_DB_URL"),
+                        api_key=os.getenv("QDRANT_KEY")
+                    )
+                    self._qdrant_clients[collection_name] = client
+        return client
+
+    def get_vector_store(self, collection_name: str) -> VectorStore:
+        vector_store = self._vector_stores.get(collection_name)
+        if vector_store is None:
+            if VECTOR_STORE_BACKEND == "local":
+                new_store = LocalVectorStore(collection_name, LOCAL_INDEX_DIR)
+            else:
+                new_store = QdrantVectorStore(collection_name, self.get_qdrant_client(collection_name))
+            with self._lock:
+                vector_store = self._vector_stores.setdefault(collection_name, new_store)
+        return vector_store
+
+    def get_sparse_index(self, collection_name: str) -> BM25Index:
+        sparse_index = self._sparse_indexes.get(collection_name)
+        if sparse_index is None:
+            with self._lock:
+                sparse_index = self._sparse_indexes.get(collection_name)
+                if sparse_index is None:
+                    sparse_index = BM25Index(collection_name)
+                    self._sparse_indexes[collection_name] = sparse_index
+        return sparse_index
+
+    def warm_up(self, collection_names: list[str] = None):
+        self.get_embedding_model()
+        for collection_name in collection_names or []:
+            self.get_vector_store(collection_name)
+
+    def shutdown(self):
+        with self._lock:
+            for collection_name, vector_store in self._vector_stores.items():
+                try:
+                    vector_store.close()
+                except Exception as e:
+                    logging.exception(f"Closing vector store of {collection_name} failed: {e}")
+            self._vector_stores.clear()
+            self._sparse_indexes.clear()
+            for collection_name, client in self._qdrant_clients.items():
+                try:
+                    client.close()
+                except Exception as e:
+                    logging.exception(f"Closing Qdrant client of {collection_name} failed: {e}")
+            self._qdrant_clients.clear()
+            self._model = None
+
+
+def warm_up_collections() -> list[str]:
+    # comma separated names of collections to open connections to at app startup
+    return [name.strip() for name in os.getenv("WARM_UP_COLLECTIONS", "").split(",") if name.strip()]
+
+
+resource_pool = ResourcePool()
@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import logging
+import itertools
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from atomic_io import write_json_atomically
+
+COLLECTION_VERSIONS_FILE = os.getenv("COLLECTION_VERSIONS_FILE", "./data_store/collection_versions.json")
+
+
+def read_collection_versions() -> dict:
+    try:
+        with open(COLLECTION_VERSIONS_FILE, 'r', encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def bump_collection_version(collection_name: str):
+    # versions file is shared with API processes, so their caches drop answers built from older collection content
+    versions = read_collection_versions()
+    versions[collection_name] = versions.get(collection_name, 0) + 1
+    write_json_atomically(COLLECTION_VERSIONS_FILE, versions)
+
+
+class SemanticCache:
+    """
+    Answers cache keyed on query embeddings.
+
+    A stored answer is served for every question of the same collection whose embedding is within
+    max_distance (cosine distance) of the cached one. Entries expire after ttl seconds and the least
+    recently used ones are evicted above max_entries per collection.
+    """
+
+    def __init__(self, max_distance: float, ttl: float, max_entries: int, enabled: bool = True):
+        self.max_distance = max_distance
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._keys = itertools.count()
+        self._namespaces = {}
+        self._matrices = {}
+        self._versions = {}
+        self._versions_mtime = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def lookup(self, collection_name: str, query_vector) -> dict | None:
+        if not self.enabled:
+            return None
+        vector = self._normalize(query_vector)
+        with self._lock:
+            self._sync_versions()
+            entries = self._namespaces.get(collection_name)
+            if entries:
+                self._drop_expired(collection_name)
+            if not entries:
+                self.misses += 1
+                return None
+            keys, matrix = self._matrix(collection_name)
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            if 1.0 - similarities[best] > self.max_distance:
+                self.misses += 1
+                return None
+            key = keys[best]
+            entries.move_to_end(key)
+            self.hits += 1
+            return entries[key]["answer"]
+
+    def store(self, collection_name: str, query_vector, answer: dict):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._sync_versions()
+            entries = self._namespaces.setdefault(collection_name, OrderedDict())
+            self._versions.setdefault(collection_name, read_collection_versions().get(collection_name, 0))
+            key = next(self._keys)
+            entries[key] = {"vector": self._normalize(query_vector), "answer": answer, "created_at": time.monotonic()}
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+                self.evictions += 1
+            self._matrices.pop(collection_name, None)
+
+    def invalidate(self, collection_name: str):
+        with self._lock:
+            if self._namespaces.pop(collection_name, None):
+                self.invalidations += 1
+            self._matrices.pop(collection_name, None)
+            self._versions.pop(collection_name, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "entries": {name: len(entries) for name, entries in self._namespaces.items()},
+            }
+
+    def _drop_expired(self, collection_name: str):
+        entries = self._namespaces[collection_name]
+        now = time.monotonic()
+        expired = [key for key, entry in entries.items() if now - entry["created_at"] > self.ttl]
+        for key in expired:
+            del entries[key]
+            self.evictions += 1
+        if expired:
+            self._matrices.pop(collection_name, None)
+
+    def _matrix(self, collection_name: str):
+        if collection_name not in self._matrices:
+            entries = self._namespaces[collection_name]
+            keys = list(entries.keys())
+            self._matrices[collection_name] = (keys, np.stack([entries[key]["vector"] for key in keys]))
+        return self._matrices[collection_name]
+
+    def _sync_versions(self):
+        try:
+            mtime = os.stat(COLLECTION_VERSIONS_FILE).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime == self._versions_mtime:
+            return
+        self._versions_mtime = mtime
+        versions = read_collection_versions()
+        for collection_name, seen_version in list(self._versions.items()):
+            if versions.get(collection_name, 0) != seen_version:
+                logging.log(logging.INFO, f"Collection {collection_name} was re-populated, dropping cached answers")
+                if self._namespaces.pop(collection_name, None):
+                    self.invalidations += 1
+                self._matrices.pop(collection_name, None)
+                del self._versions[collection_name]
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+# off by default: questions about different herbs can embed close to each other, check a max distance with
+# benchmarks.bench_semantic_cache before enabling the cache
+answer_cache = SemanticCache(
+    max_distance=float(os.getenv("SEMANTIC_CACHE_MAX_DISTANCE", 0.01)),
+    ttl=float(os.getenv("SEMANTIC_CACHE_TTL", 3600)),
+    max_entries=int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 1000)),
+    enabled=os.getenv("SEMANTIC_CACHE_ENABLED", "false").lower() == "true",
+)
@@ -0,0 +1,145 @@
+import os
+import re
+import json
+import math
+import threading
+from collections import Counter, defaultdict
+
+from atomic_io import write_json_atomically
+
+SPARSE_INDEX_DIR = os.getenv("SPARSE_INDEX_DIR", "./data_store/sparse_index")
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from", "how", "i", "in", "is", "it",
+    "its", "of", "on", "or", "that", "the", "this", "to", "was", "what", "when", "where", "which", "who", "why",
+    "with", "used", "use", "about", "any", "there", "these", "those", "my", "me", "you",
+}
+
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) > 1 and token not in STOP_WORDS]
+
+
+class BM25Index:
+    """
+    Okapi BM25 keyword index of a collection's chunks, kept next to the vector store.
+
+    Catches exact plant names & constituents (e.g. "Hypericum perforatum", "hypericin") that dense search
+    scores below its threshold. Stores chunk payloads, so keyword hits need no vector store round-trip.
+    """
+
+    def __init__(self, collection_name: str, k1: float = 1.5, b: float = 0.75):
+        self.path = os.path.join(SPARSE_INDEX_DIR, f"{collection_name}.bm25.json")
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.Lock()
+        self._docs = {}
+        self._postings = defaultdict(dict)
+        self._total_length = 0
+        self._mtime = None
+        self.refresh()
+
+    def __contains__(self, point_id: str) -> bool:
+        return point_id in self._docs
+
+    def add(self, point_id: str, text: str, payload: dict):
+        with self._lock:
+            self._remove(point_id)
+            term_freqs = Counter(tokenize(text))
+            self._docs[point_id] = {"terms": term_freqs, "length": sum(term_freqs.values()), "payload": payload}
+            self._index(point_id)
+
+    def remove(self, point_ids: list[str]):
+        with self._lock:
+            for point_id in point_ids:
+                self._remove(point_id)
+
+    def search(self, query: str, limit: int, min_idf: float = 0.0,
+               min_score_ratio: float = 0.0) -> list[tuple[str, float, dict]]:
+        """
+        Top limit chunks by BM25 score of the query terms.
+
+        Terms with an IDF below min_idf (found in a large part of the chunks) don't count & hits scoring below
+        min_score_ratio of the top hit are dropped, so common words alone bring no results.
+        """
+        with self._lock:
+            docs_count = len(self._docs)
+            if not docs_count:
+                return []
+            avg_length = self._total_length / docs_count
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (docs_count - len(postings) + 0.5) / (len(postings) + 0.5))
+                if idf < min_idf:
+                    continue
+                for point_id, term_freq in postings.items():
+                    length_norm = self.k1 * (1 - self.b + self.b * self._docs[point_id]["length"] / avg_length)
+                    scores[point_id] += idf * term_freq * (self.k1 + 1) / (term_freq + length_norm)
+            top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+            top = [(point_id, score) for point_id, score in top if score >= min_score_ratio * top[0][1]]
+            return [(point_id, score, self._docs[point_id]["payload"]) for point_id, score in top]
+
+    def refresh(self):
+        # picks up the index re-written by an ETL run in another process
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        with open(self.path, 'r', encoding="utf-8") as f:
+            stored = json.load(f)
+        with self._lock:
+            self._docs = {
+                point_id: {"terms": Counter(doc["terms"]), "length": doc["length"], "payload": doc["payload"]}
+                for point_id, doc in stored.items()
+            }
+            self._postings = defaultdict(dict)
+            self._total_length = 0
+            for point_id in self._docs:
+                self._index(point_id)
+            self._mtime = mtime
+
+    def save(self):
+        with self._lock:
+            write_json_atomically(self.path, self._docs, ensure_ascii=False)
+            self._mtime = os.stat(self.path).st_mtime
+
+    def clear(self):
+        with self._lock:
+            self._docs = {}
+            self._postings = defaultdict(dict)
+            self._total_length = 0
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self._mtime = None
+
+    def _index(self, point_id: str):
+        doc = self._docs[point_id]
+        for term, term_freq in doc["terms"].items():
+            self._postings[term][point_id] = term_freq
+        self._total_length += doc["length"]
+
+    def _remove(self, point_id: str):
+        doc = self._docs.pop(point_id, None)
+        if doc is None:
+            return
+        for term in doc["terms"]:
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(point_id, None)
+                if not postings:
+                    del self._postings[term]
+        self._total_length -= doc["length"]
+
+
+def reciprocal_rank_fusion(ranked_lists: list[list[str]], k: int = 60) -> list[str]:
+    fused_scores = defaultdict(float)
+    for ranked_ids in ranked_lists:
+        for rank, point_id in enumerate(ranked_ids):
+            fused_scores[point_id] += 1.0 / (k + rank + 1)
+    return sorted(fused_scores, key=lambda point_id: fused_scores[point_id], reverse=True)
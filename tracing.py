@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import uuid
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from langchain_core.callbacks import BaseCallbackHandler
+from prometheus_client import Counter, Histogram
+
+# per-request traces: the last TRACE_HISTORY ones are kept in memory, TRACE_LOG_FILE appends them as JSON lines
+TRACE_HISTORY = int(os.getenv("TRACE_HISTORY", 100))
+TRACE_LOG_FILE = os.getenv("TRACE_LOG_FILE")
+
+# config key the request trace is passed to graph nodes under
+TRACE_CONFIG_KEY = "request_trace"
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 40.0, 80.0)
+
+request_seconds = Histogram("rag_request_seconds", "Wall time of questions answered by the graph",
+                            buckets=LATENCY_BUCKETS)
+node_seconds = Histogram("rag_node_seconds", "Wall time of graph nodes", ["node"], buckets=LATENCY_BUCKETS)
+stage_seconds = Histogram("rag_stage_seconds", "Time spent in embedding & vector search per graph node",
+                          ["node", "stage"], buckets=LATENCY_BUCKETS)
+llm_calls_total = Counter("rag_llm_calls_total", "LLM calls per graph node", ["node"])
+llm_tokens_total = Counter("rag_llm_tokens_total", "LLM prompt & completion tokens per graph node", ["node", "kind"])
+context_tokens = Histogram("rag_context_tokens", "Estimated tokens of the generation context after compression",
+                           buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000))
+context_tokens_saved_total = Counter("rag_context_tokens_saved_total",
+                                     "Estimated context tokens removed by context compression")
+iteration_decisions_total = Counter("rag_iteration_decisions_total", "Routing decisions after document grading",
+                                    ["decision", "reason"])
+node_iteration = Histogram("rag_node_iteration", "Query correction loop iteration graph nodes ran in", ["node"],
+                           buckets=(0, 1, 2, 3))
+
+current_span = ContextVar("current_span", default=None)
+
+
+class NodeSpan:
+    """Timings & LLM usage of a single graph node run."""
+
+    def __init__(self, node: str, iteration: int):
+        self.node = node
+        self.iteration = iteration
+        self.started_at = time.time()
+        self.wall_ms = 0.0
+        self.embed_ms = 0.0
+        self.search_ms = 0.0
+        self.llm_calls = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.context_tokens = 0
+        self.context_tokens_saved = 0
+        # LLM calls of a node can finish on several threads (e.g. concurrent grading)
+        self._lock = threading.Lock()
+
+    def add_stage_time(self, stage: str, seconds: float):
+        with self._lock:
+            setattr(self, f"{stage}_ms", getattr(self, f"{stage}_ms") + seconds * 1000)
+
+    def add_llm_call(self, prompt_tokens: int, completion_tokens: int):
+        with self._lock:
+            self.llm_calls += 1
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+
+    def to_dict(self) -> dict:
+        return {
+            "node": self.node,
+            "iteration": self.iteration,
+            "started_at": self.started_at,
+            "wall_ms": round(self.wall_ms, 3),
+            "embed_ms": round(self.embed_ms, 3),
+            "search_ms": round(self.search_ms, 3),
+            "llm_calls": self.llm_calls,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "context_tokens": self.context_tokens,
+            "context_tokens_saved": self.context_tokens_saved,
+        }
+
+
+class RequestTrace:
+    """Spans of all graph nodes run for a single question, in the order they started."""
+
+    def __init__(self, question: str, collection_name: str):
+        self.trace_id = uuid.uuid4().hex
+        self.question = question
+        self.collection_name = collection_name
+        self.started_at = time.time()
+        self.wall_ms = None
+        self.spans = []
+        self.decisions = []
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, span: NodeSpan):
+        with self._lock:
+            self.spans.append(span)
+
+    def add_decision(self, decision: dict):
+        with self._lock:
+            self.decisions.append(decision)
+
+    def finish(self):
+        seconds = time.perf_counter() - self._start
+        self.wall_ms = seconds * 1000
+        request_seconds.observe(seconds)
+        trace_log.record(self)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = [span.to_dict() for span in self.spans]
+            decisions = list(self.decisions)
+        return {
+            "trace_id": self.trace_id,
+            "question": self.question,
+            "collection_name": self.collection_name,
+            "started_at": self.started_at,
+            "wall_ms": round(self.wall_ms, 3) if self.wall_ms is not None else None,
+            "llm_calls": sum(span["llm_calls"] for span in spans),
+            "prompt_tokens": sum(span["prompt_tokens"] for span in spans),
+            "completion_tokens": sum(span["completion_tokens"] for span in spans),
+            "context_tokens_saved": sum(span["context_tokens_saved"] for span in spans),
+            "spans": spans,
+            "decisions": decisions,
+        }
+
+
+class TraceLog:
+    """Recently finished request traces, optionally appended to a JSON lines file."""
+
+    def __init__(self, max_traces: int, log_file: str = None):
+        self.log_file = log_file
+        self._lock = threading.Lock()
+        self._traces = deque(maxlen=max_traces)
+
+    def record(self, trace: RequestTrace):
+        trace_dict = trace.to_dict()
+        with self._lock:
+            self._traces.append(trace_dict)
+            if self.log_file:
+                os.makedirs(os.path.dirname(self.log_file) or ".", exist_ok=True)
+                with open(self.log_file, 'a', encoding="utf-8") as f:
+                    f.write(json.dumps(trace_dict, ensure_ascii=False) + "\n")
+
+    def recent(self, limit: int = None) -> list[dict]:
+        with self._lock:
+            traces = list(self._traces)
+        return traces[-limit:] if limit else traces
+
+    def get(self, trace_id: str):
+        with self._lock:
+            return next((trace for trace in self._traces if trace["trace_id"] == trace_id), None)
+
+
+trace_log = TraceLog(TRACE_HISTORY, TRACE_LOG_FILE)
+
+
+def trace_config(trace: RequestTrace) -> dict:
+    return {"configurable": {TRACE_CONFIG_KEY: trace}}
+
+
+def traced_node(node):
+    """
+    Wraps a graph node, so every run records a span with its wall time, embed & search time, LLM calls & tokens.
+
+    Spans are added to the request trace passed in the graph config by trace_config(), metrics are always recorded.
+    """
+    # langgraph passes the config only to functions with a config parameter
+    def wrapper(state, config):
+        span = NodeSpan(node.__name__, state.get("query_correction_count", 0))
+        token = current_span.set(span)
+        start = time.perf_counter()
+        try:
+            return node(state)
+        finally:
+            span.wall_ms = (time.perf_counter() - start) * 1000
+            current_span.reset(token)
+            _observe_span(span)
+            trace = (config or {}).get("configurable", {}).get(TRACE_CONFIG_KEY)
+            if trace is not None:
+                trace.add_span(span)
+
+    wrapper.__name__ = node.__name__
+    wrapper.__qualname__ = node.__qualname__
+    wrapper.__doc__ = node.__doc__
+    return wrapper
+
+
+def record_decision(config: dict, decision: str, reason: str, **details):
+    """Counts a routing decision of the graph & adds it with its details to the request trace, if there's one."""
+    iteration_decisions_total.labels(decision, reason).inc()
+    trace = (config or {}).get("configurable", {}).get(TRACE_CONFIG_KEY)
+    if trace is not None:
+        trace.add_decision({"decision": decision, "reason": reason, **details})
+
+
+@contextmanager
+def record_stage(stage: str):
+    """Adds the time of the block to the "embed" or "search" time of the graph node it runs in."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        span = current_span.get()
+        if span is not None:
+            span.add_stage_time(stage, time.perf_counter() - start)
+
+
+def record_context_tokens(tokens_before: int, tokens_after: int):
+    """Adds estimated generation context tokens before & after compression to the graph node it runs in."""
+    span = current_span.get()
+    if span is not None:
+        span.context_tokens = tokens_after
+        span.context_tokens_saved = tokens_before - tokens_after
+
+
+class LLMUsageCallback(BaseCallbackHandler):
+    """Counts LLM calls & token usage of the graph node the call runs in."""
+
+    def on_llm_end(self, response, **kwargs):
+        span = current_span.get()
+        if span is None:
+            return
+        prompt_tokens, completion_tokens = 0, 0
+        for generations in response.generations:
+            for generation in generations:
+                usage = getattr(getattr(generation, "message", None), "usage_metadata", None)
+                if usage:
+                    prompt_tokens += usage.get("input_tokens", 0)
+                    completion_tokens += usage.get("output_tokens", 0)
+        if not prompt_tokens and not completion_tokens:
+            token_usage = (response.llm_output or {}).get("token_usage") or {}
+            prompt_tokens = token_usage.get("prompt_tokens", 0)
+            completion_tokens = token_usage.get("completion_tokens", 0)
+        span.add_llm_call(prompt_tokens, completion_tokens)
+
+
+llm_usage_callback = LLMUsageCallback()
+
+
+def _observe_span(span: NodeSpan):
+    node_seconds.labels(span.node).observe(span.wall_ms / 1000)
+    node_iteration.labels(span.node).observe(span.iteration)
+    if span.embed_ms:
+        stage_seconds.labels(span.node, "embed").observe(span.embed_ms / 1000)
+    if span.search_ms:
+        stage_seconds.labels(span.node, "search").observe(span.search_ms / 1000)
+    if span.context_tokens:
+        context_tokens.observe(span.context_tokens)
+        context_tokens_saved_total.inc(span.context_tokens_saved)
+    if span.llm_calls:
+        llm_calls_total.labels(span.node).inc(span.llm_calls)
+        llm_tokens_total.labels(span.node, "prompt").inc(span.prompt_tokens)
+        llm_tokens_total.labels(span.node, "completion").inc(span.completion_tokens)
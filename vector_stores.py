@@ -0,0 +1,296 @@
+import os
+import json
+import logging
+import threading
+from abc import ABC, abstractmethod
+
+import numpy as np
+from qdrant_client import QdrantClient, models
+
+from atomic_io import atomic_write
+
+
+class VectorStore(ABC):
+    """
+    Vector storage & search backend of a single collection used by QdrantManager.
+
+    Search results & records use qdrant_client models, so callers don't depend on the backend.
+    """
+
+    @abstractmethod
+    def collection_exists(self) -> bool:
+        pass
+
+    @abstractmethod
+    def create_collection(self, size: int, quantization_config=None):
+        pass
+
+    @abstractmethod
+    def upsert(self, points: list[models.PointStruct]):
+        pass
+
+    @abstractmethod
+    def delete(self, point_ids: list[str]):
+        pass
+
+    @abstractmethod
+    def search(self, query_vector, limit: int, score_threshold: float = None,
+               search_params: models.SearchParams = None, with_vectors: bool = False) -> list[models.ScoredPoint]:
+        pass
+
+    def search_batch(self, query_vectors: list, limit: int, score_threshold: float = None,
+                     search_params: models.SearchParams = None,
+                     with_vectors: bool = False) -> list[list[models.ScoredPoint]]:
+        return [self.search(query_vector, limit, score_threshold, search_params, with_vectors)
+                for query_vector in query_vectors]
+
+    @abstractmethod
+    def retrieve(self, point_ids: list[str], with_vectors: bool = False) -> list[models.Record]:
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class QdrantVectorStore(VectorStore):
+    def __init__(self, collection_name: str, client: QdrantClient):
+        self.collection_name = collection_name
+        self.client = client
+
+    def collection_exists(self) -> bool:
+        return self.client.collection_exists(self.collection_name)
+
+    def create_collection(self, size: int, quantization_config=None):
+        self.client.create_collection(
+            collection_name=self.collection_name,
+            vectors_config=models.VectorParams(
+                size=size,
+                distance=models.Distance.COSINE,
+                datatype=models.Datatype.FLOAT32,  # UINT8 made vectors filled with zeros (too little precision)
+                on_disk=quantization_config is not None  # quantized vectors stay in RAM, originals for rescoring on disk
+            ),
+            quantization_config=quantization_config
+        )
+
+    def upsert(self, points: list[models.PointStruct]):
+        self.client.upsert(collection_name=self.collection_name, points=points, wait=True)
+
+    def delete(self, point_ids: list[str]):
+        self.client.delete(
+            collection_name=self.collection_name,
+            points_selector=models.PointIdsList(points=point_ids),
+            wait=True
+        )
+
+    def search(self, query_vector, limit: int, score_threshold: float = None,
+               search_params: models.SearchParams = None, with_vectors: bool = False) -> list[models.ScoredPoint]:
+        return self.client.search(
+            collection_name=self.collection_name,
+            query_vector=query_vector,
+            search_params=search_params,
+            score_threshold=score_threshold,
+            limit=limit,
+            with_vectors=with_vectors
+        )
+
+    def search_batch(self, query_vectors: list, limit: int, score_threshold: float = None,
+                     search_params: models.SearchParams = None,
+                     with_vectors: bool = False) -> list[list[models.ScoredPoint]]:
+        # all searches in a single request
+        return self.client.search_batch(
+            collection_name=self.collection_name,
+            requests=[
+                models.SearchRequest(
+                    vector=list(map(float, query_vector)),
+                    limit=limit,
+                    params=search_params,
+                    score_threshold=score_threshold,
+                    with_payload=True,
+                    with_vector=with_vectors
+                ) for query_vector in query_vectors
+            ]
+        )
+
+    def retrieve(self, point_ids: list[str], with_vectors: bool = False) -> list[models.Record]:
+        return self.client.retrieve(self.collection_name, point_ids, with_vectors=with_vectors)
+
+
+class LocalVectorStore(VectorStore):
+    """
+    In-process cosine search over a NumPy matrix of normalized vectors.
+
+    The index is kept in index_dir as a .npy matrix, memory-mapped when opened, and a JSON file with point IDs
+    & payloads. Changes are kept in memory until flush(). Search is always exact, so search params are ignored.
+    Searches pick up an index flushed by another process (e.g. an ETL run), unless there are unflushed changes.
+    """
+
+    def __init__(self, collection_name: str, index_dir: str):
+        self.collection_name = collection_name
+        self.vectors_path = os.path.join(index_dir, f"{collection_name}.vectors.npy")
+        self.payloads_path = os.path.join(index_dir, f"{collection_name}.payloads.json")
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._ids = []
+        self._payloads = []
+        self._rows = {}
+        self._pending_vectors = []
+        self._dirty = False
+        self._mtime = None
+        self.refresh()
+
+    def collection_exists(self) -> bool:
+        self.refresh()
+        return self._vectors is not None
+
+    def create_collection(self, size: int, quantization_config=None):
+        if quantization_config is not None:
+            logging.warning(f"Local vector store keeps float32 vectors, quantization of {self.collection_name} ignored")
+        with self._lock:
+            self._vectors = np.zeros((0, size), dtype=np.float32)
+            self._ids, self._payloads, self._rows, self._pending_vectors = [], [], {}, []
+            self._dirty = True
+        self.flush()
+
+    def upsert(self, points: list[models.PointStruct]):
+        with self._lock:
+            if self._vectors is None:
+                raise ValueError(f"Local collection {self.collection_name} doesn't exist, create it first")
+            for point in points:
+                point_id = str(point.id)
+                vector = self._normalize(point.vector)
+                row = self._rows.get(point_id)
+                if row is None:
+                    self._rows[point_id] = len(self._ids)
+                    self._ids.append(point_id)
+                    self._payloads.append(point.payload)
+                    self._pending_vectors.append(vector)
+                else:
+                    self._materialize(writable=True)
+                    self._vectors[row] = vector
+                    self._payloads[row] = point.payload
+            self._dirty = True
+
+    def delete(self, point_ids: list[str]):
+        with self._lock:
+            removed_rows = {self._rows[str(point_id)] for point_id in point_ids if str(point_id) in self._rows}
+            if not removed_rows:
+                return
+            self._materialize()
+            kept_rows = [row for row in range(len(self._ids)) if row not in removed_rows]
+            self._vectors = np.ascontiguousarray(self._vectors[kept_rows])
+            self._ids = [self._ids[row] for row in kept_rows]
+            self._payloads = [self._payloads[row] for row in kept_rows]
+            self._rows = {point_id: row for row, point_id in enumerate(self._ids)}
+            self._dirty = True
+
+    def search(self, query_vector, limit: int, score_threshold: float = None,
+               search_params: models.SearchParams = None, with_vectors: bool = False) -> list[models.ScoredPoint]:
+        self.refresh()
+        with self._lock:
+            self._materialize()
+            vectors, ids, payloads = self._vectors, self._ids, self._payloads
+        if not len(ids):
+            return []
+        scores = vectors @ self._normalize(query_vector)
+        return self._top_points(scores, limit, score_threshold, vectors, ids, payloads, with_vectors)
+
+    def search_batch(self, query_vectors: list, limit: int, score_threshold: float = None,
+                     search_params: models.SearchParams = None,
+                     with_vectors: bool = False) -> list[list[models.ScoredPoint]]:
+        self.refresh()
+        with self._lock:
+            self._materialize()
+            vectors, ids, payloads = self._vectors, self._ids, self._payloads
+        if not len(ids) or not len(query_vectors):
+            return [[] for _ in query_vectors]
+        # scores of all queries in one matrix product
+        scores = vectors @ np.stack([self._normalize(query_vector) for query_vector in query_vectors]).T
+        return [self._top_points(scores[:, column], limit, score_threshold, vectors, ids, payloads, with_vectors)
+                for column in range(scores.shape[1])]
+
+    @staticmethod
+    def _top_points(scores: np.ndarray, limit: int, score_threshold: float, vectors: np.ndarray, ids: list,
+                    payloads: list, with_vectors: bool) -> list[models.ScoredPoint]:
+        if len(scores) > limit:
+            top_rows = np.argpartition(-scores, limit - 1)[:limit]
+        else:
+            top_rows = np.arange(len(scores))
+        top_rows = top_rows[np.argsort(-scores[top_rows])]
+        if score_threshold is not None:
+            top_rows = top_rows[scores[top_rows] >= score_threshold]
+        return [
+            models.ScoredPoint(
+                id=ids[row],
+                version=0,
+                score=float(scores[row]),
+                payload=payloads[row],
+                vector=vectors[row].tolist() if with_vectors else None
+            ) for row in top_rows
+        ]
+
+    def retrieve(self, point_ids: list[str], with_vectors: bool = False) -> list[models.Record]:
+        self.refresh()
+        with self._lock:
+            self._materialize()
+            rows = [self._rows[str(point_id)] for point_id in point_ids if str(point_id) in self._rows]
+            return [
+                models.Record(
+                    id=self._ids[row],
+                    payload=self._payloads[row],
+                    vector=self._vectors[row].tolist() if with_vectors else None
+                ) for row in rows
+            ]
+
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            self._materialize()
+            # both files are complete before either one is swapped in
+            with atomic_write(self.vectors_path, 'wb') as vectors_file, \
+                    atomic_write(self.payloads_path) as payloads_file:
+                np.save(vectors_file, self._vectors)
+                json.dump({"ids": self._ids, "payloads": self._payloads}, payloads_file, ensure_ascii=False)
+            self._vectors = np.load(self.vectors_path, mmap_mode="r")
+            self._mtime = os.stat(self.vectors_path).st_mtime
+            self._dirty = False
+
+    def refresh(self):
+        # picks up the index flushed by an ETL run in another process, the vectors file is swapped in last
+        try:
+            mtime = os.stat(self.vectors_path).st_mtime
+        except FileNotFoundError:
+            return
+        if mtime == self._mtime:
+            return
+        vectors = np.load(self.vectors_path, mmap_mode="r")
+        with open(self.payloads_path, 'r', encoding="utf-8") as f:
+            stored = json.load(f)
+        if len(stored["ids"]) != len(vectors):
+            # caught between the two files of a flush, loaded by a later search
+            return
+        with self._lock:
+            if self._dirty:
+                return
+            self._vectors = vectors
+            self._ids = stored["ids"]
+            self._payloads = stored["payloads"]
+            self._rows = {point_id: row for row, point_id in enumerate(self._ids)}
+            self._pending_vectors = []
+            self._mtime = mtime
+
+    def _materialize(self, writable: bool = False):
+        if self._pending_vectors:
+            self._vectors = np.vstack([self._vectors, np.stack(self._pending_vectors)])
+            self._pending_vectors = []
+        elif writable and isinstance(self._vectors, np.memmap):
+            self._vectors = np.array(self._vectors)
+
+    @staticmethod
+    def _normalize(vector) -> np.ndarray:
+        vector = np.asarray(vector, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector